@@ -2,20 +2,30 @@ import os
 import sys
 
 from arkos.config import Config
-from arkos.storage import Storage
+from arkos.storage import Storage, save_snapshot, load_snapshot
 from arkos.utilities import new_logger
 from arkos.connections import ConnectionsManager
 
 
 class StorageControl:
     def __init__(self):
-        self.apps = Storage(["installed", "available", "updatable"])
-        self.sites = Storage(["sites"])
+        self.apps = Storage(["installed", "available", "updatable"], ["type"])
+        self.sites = Storage(["sites"], ["name", "meta.id"])
         self.certs = Storage(["certificates", "authorities"])
-        self.dbs = Storage(["databases", "users", "managers"])
-        self.points = Storage(["points"])
+        self.dbs = Storage(["databases", "users", "managers"], ["manager.id"])
+        self.points = Storage(["points"], ["name", "path"])
         self.updates = Storage(["updates"])
-        self.policies = Storage(["policies"])
+        self.policies = Storage(["policies"], ["type"])
+
+    def save_snapshot(self, name, data, watch=[]):
+        return save_snapshot(self._snapshot_path(name), data, watch)
+
+    def load_snapshot(self, name, watch=[]):
+        return load_snapshot(self._snapshot_path(name), watch)
+
+    def _snapshot_path(self, name):
+        return os.path.join(config.get("general", "cache_dir", "/var/cache/arkos"),
+            "snapshots", "%s.pickle" % name)
 
 
 config = Config()
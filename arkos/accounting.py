@@ -0,0 +1,119 @@
+import psutil
+import threading
+import time
+
+from arkos import conns, applications, websites
+
+ATTRS = ["pid", "ppid", "create_time", "cpu_times", "memory_info",
+    "io_counters", "num_fds", "cwd"]
+
+
+class ResourceAccounting:
+    # Attributes CPU, memory, IO and open files to installed apps and
+    # websites. Each sample is one psutil.process_iter pass with the needed
+    # attributes prefetched; processes are matched to owners by Supervisor
+    # program PID (and descendants), systemd cgroup, or working directory
+    # under a site's path. CPU is a percentage of one core since the
+    # previous sample.
+    def __init__(self):
+        self._cpu = {}
+        self._time = None
+        self._lock = threading.Lock()
+
+    def sample(self):
+        units, pids, paths = _owners()
+        procs = {}
+        for p in psutil.process_iter(attrs=ATTRS, ad_value=None):
+            procs[p.info["pid"]] = p.info
+        usage = {"apps": {}, "sites": {}}
+        with self._lock:
+            now = time.time()
+            elapsed = now - self._time if self._time else None
+            cpu = {}
+            for pid, info in procs.items():
+                key = (pid, info["create_time"])
+                if info["cpu_times"]:
+                    cpu[key] = info["cpu_times"].user + info["cpu_times"].system
+                owner = _owner(pid, procs, units, pids, paths)
+                if not owner:
+                    continue
+                u = usage[owner[0]].setdefault(owner[1], {"cpu": 0.0, "rss": 0,
+                    "read_bytes": 0, "write_bytes": 0, "fds": 0, "processes": 0})
+                u["processes"] += 1
+                if elapsed and key in cpu and key in self._cpu:
+                    u["cpu"] += max(cpu[key] - self._cpu[key], 0) / elapsed * 100
+                if info["memory_info"]:
+                    u["rss"] += info["memory_info"].rss
+                if info["io_counters"]:
+                    u["read_bytes"] += info["io_counters"].read_bytes
+                    u["write_bytes"] += info["io_counters"].write_bytes
+                u["fds"] += info["num_fds"] or 0
+            self._cpu, self._time = cpu, now
+        return usage
+
+
+def get(atype=None, id=None):
+    data = accounting.sample()
+    if atype:
+        data = data[atype]
+        return data.get(id) if id else data
+    return data
+
+def _owners():
+    # Builds lookup tables of systemd unit -> owner, Supervisor program
+    # PID -> owner and site path -> owner. A daemon dependency shared by
+    # several apps (php-fpm, say) is not attributed to any one of them.
+    units, claims = {}, {}
+    for app in applications.get() or []:
+        for s in getattr(app, "services", []):
+            if s.get("binary"):
+                units["%s.service" % s["binary"]] = ("apps", app.id)
+        for dep in getattr(app, "dependencies", []):
+            if dep.get("daemon"):
+                claims.setdefault("%s.service" % dep["daemon"], set()).add(app.id)
+    for unit in claims:
+        if not unit in units and len(claims[unit]) == 1:
+            units[unit] = ("apps", list(claims[unit])[0])
+
+    sites = websites.get() or []
+    names = dict([(x.name, ("sites", x.name)) for x in sites])
+    pids = {}
+    try:
+        for x in conns.Supervisor.getAllProcessInfo():
+            owner = names.get(x["name"]) or units.get("%s.service" % x["name"])
+            if x["pid"] and owner:
+                pids[x["pid"]] = owner
+    except Exception:
+        pass
+    paths = sorted([(x.path.rstrip("/") + "/", ("sites", x.name)) for x in sites if x.path],
+        key=lambda x: len(x[0]), reverse=True)
+    return units, pids, paths
+
+def _owner(pid, procs, units, pids, paths):
+    # Supervisor programs and their children
+    x, depth = pid, 0
+    while x and depth < 16:
+        if x in pids:
+            return pids[x]
+        x = procs[x]["ppid"] if x in procs else None
+        depth += 1
+    # systemd services, by the unit in the process' cgroup path
+    try:
+        with open("/proc/%s/cgroup" % pid, "r") as f:
+            for line in f:
+                for part in line.strip().split(":", 2)[-1].split("/"):
+                    if part in units:
+                        return units[part]
+    except IOError:
+        pass
+    # Anything else working inside a site's directory
+    cwd = procs[pid]["cwd"]
+    if cwd:
+        cwd = cwd.rstrip("/") + "/"
+        for path, owner in paths:
+            if cwd.startswith(path):
+                return owner
+    return None
+
+
+accounting = ResourceAccounting()
@@ -1,17 +1,26 @@
-import base64
+import glob
 import imp
 import inspect
 import json
 import os
 import shutil
+import sys
 import tarfile
+import threading
+import time
+import urllib2
 
 from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
-from arkos import config, storage, logger, tracked_services
+from arkos import config, storage, logger, tracked_services, artifacts
 from arkos.system import packages, services
 from arkos.languages import python
-from arkos.utilities import api, DefaultMessage
+from arkos.utilities import api, DefaultMessage, JSONBase64Reader
+
+# Submodules whose manager class, rather than the module, is kept on the app
+MODULE_ATTRS = {"database": "_database_mgr", "website": "_website",
+    "backup": "_backup"}
 
 
 class App:
@@ -19,89 +28,126 @@ class App:
         self.__dict__.update(entries)
         self.loadable = False
         self.error = ""
+        self._imported = set()
+        self._timings = {}
+
+    def __getattr__(self, name):
+        # Module attributes resolve on first access; only the submodule
+        # asked for is imported, and the result stays on the instance
+        for x in self.__dict__.get("modules") or []:
+            if name == MODULE_ATTRS.get(x, "_%s" % x) \
+                    and not x in self.__dict__.get("_imported", [x]):
+                self.load_module(x)
+                return getattr(self, name)
+        raise AttributeError(name)
 
     def get_module(self, mtype):
         return getattr(self, "_%s"%mtype) if hasattr(self, "_%s"%mtype) else None
-    
-    def load(self, verify=True):
+
+    def load(self, verify=True, imports=True, status=None):
+        start = time.time()
+        try:
+            if imports:
+                self.load_modules()
+            if verify and not self.error:
+                self.verify_dependencies(status)
+            for s in self.services:
+                if s["ports"]:
+                    tracked_services.register(self.id, s["binary"], s["name"], 
+                        self.icon, s["ports"], fw=False)
+        except Exception, e:
+            self.loadable = False
+            self.error = "Module error: %s" % str(e)
+            logger.warn("Failed to load %s -- %s" % (self.name, str(e)))
+        self._timings["load"] = time.time() - start
+
+    def load_modules(self):
+        for x in self.modules:
+            self.load_module(x)
+
+    def load_module(self, mtype):
+        imp.acquire_lock()
         try:
-            module = imp.load_module(self.id, *imp.find_module(self.id, [os.path.join(config.get("apps", "app_dir"))]))
-            for x in self.modules:
-                submod = imp.load_module("%s.%s"%(self.id,x), *imp.find_module(x, [os.path.join(config.get("apps", "app_dir"), self.id)]))
+            if mtype in self._imported:
+                return
+            self._imported.add(mtype)
+            start = time.time()
+            app_dir = config.get("apps", "app_dir")
+            if not self.id in sys.modules:
+                imp.load_module(self.id, *imp.find_module(self.id, [app_dir]))
+            submod = imp.load_module("%s.%s"%(self.id,mtype), *imp.find_module(mtype, [os.path.join(app_dir, self.id)]))
+            if mtype in MODULE_ATTRS:
                 classes = inspect.getmembers(submod, inspect.isclass)
                 mgr = None
                 for y in classes:
                     if y[0] in ["DatabaseManager", "Site", "BackupController"]:
                         mgr = y[1]
                         break
-                if x == "database":
-                    for y in classes:
-                        if issubclass(y[1], mgr) and y[1] != mgr:
-                            setattr(self, "_database_mgr", y[1])
-                elif x == "website":
-                    for y in classes:
-                        if issubclass(y[1], mgr) and y[1] != mgr:
-                            setattr(self, "_website", y[1])
-                elif x == "backup":
-                    for y in classes:
-                        if issubclass(y[1], mgr) and y[1] != mgr:
-                            setattr(self, "_backup", y[1])
-                else:
-                    setattr(self, "_%s"%x, submod)
-            if verify:
-                self.verify_dependencies()
-            for s in self.services:
-                if s["ports"]:
-                    tracked_services.register(self.id, s["binary"], s["name"], 
-                        self.icon, s["ports"], fw=False)
+                for y in classes:
+                    if issubclass(y[1], mgr) and y[1] != mgr:
+                        setattr(self, MODULE_ATTRS[mtype], y[1])
+            else:
+                setattr(self, "_%s"%mtype, submod)
+            self._timings["modules"] = self._timings.get("modules", 0) + time.time() - start
         except Exception, e:
             self.loadable = False
             self.error = "Module error: %s" % str(e)
             logger.warn("Failed to load %s -- %s" % (self.name, str(e)))
-    
-    def verify_dependencies(self):
+        finally:
+            imp.release_lock()
+
+    def get_missing(self):
+        # System packages this app needs that are not installed yet
+        missing = []
+        for dep in self.dependencies:
+            if dep["type"] == "system":
+                if dep["binary"] and not _dep_check(("binary", dep["binary"]), find_executable, dep["binary"]):
+                    missing.append(dep["package"])
+                elif not _dep_check(("system", dep["package"]), packages.is_installed, dep["package"]):
+                    missing.append(dep["package"])
+        return missing
+
+    def verify_dependencies(self, status=None):
+        # status is the result of a transaction that already installed the
+        # missing system packages of several apps; without it this app's
+        # own missing packages are installed in one transaction
+        start = time.time()
         verify, error = True, ""
+        if status is None:
+            status = install_system(self.get_missing())
         for dep in self.dependencies:
             if dep["type"] == "system":
-                to_pacman = ""
-                if dep["binary"] and not find_executable(dep["binary"]):
-                    to_pacman = dep["package"]
-                elif packages.is_installed(dep["package"]):
-                    to_pacman = dep["package"]
-                if to_pacman:
-                    try:
-                        logger.debug(" *** Installing %s..." % to_pacman)
-                        packages.install([to_pacman], query=True)
-                    except:
-                        error = "Couldn't install %s" % to_pacman
+                if dep["package"] in status:
+                    if not status[dep["package"]] in ["installed", "already installed"]:
+                        error = "Couldn't install %s" % dep["package"]
+                        verify = False
+                    if dep.has_key("internal") and dep["internal"]:
+                        error = "Restart required"
                         verify = False
-                    finally:
-                        if dep.has_key("internal") and dep["internal"]:
-                            error = "Restart required"
-                            verify = False
             if dep["type"] == "python":
                 to_pip = ""
                 if dep["module"]:
-                    try:
-                        __import__(dep["module"])
-                    except ImportError:
+                    if not _dep_check(("module", dep["module"]), _importable, dep["module"]):
                         to_pip = dep["package"]
                 else:
-                    if not python.is_installed(dep["package"]):
+                    if not _dep_check(("python", dep["package"]), python.is_installed, dep["package"]):
                         to_pip = dep["package"]
                 if to_pip:
                     try:
                         logger.debug(" *** Installing %s (via pip)..." % to_pip)
-                        python.install([to_pip])
+                        with _install_lock:
+                            python.install([to_pip])
                     except:
                         error = "Couldn't install %s" % to_pip
                         verify = False
                     finally:
+                        _dep_cache.clear()
                         if dep.has_key("internal") and dep["internal"]:
                             error = "Restart required"
                             verify = False
         self.loadable = verify
         self.error = error
+        self._timings["verify"] = time.time() - start
         return verify
     
     def uninstall(self, force=False, message=DefaultMessage()):
@@ -109,6 +155,8 @@ class App:
             message.update("info", "Uninstalling application...")
         exclude = ['openssl', 'openssh', 'nginx', 'python2', 'git']
         for app in storage.apps.get("installed"):
+            if app.id == self.id:
+                continue
             for item in app.dependencies:
                 if item["type"] == "app" and item["package"] == self.id and not force:
                     if message:
@@ -118,12 +166,20 @@ class App:
                         raise Exception("Cannot remove, %s depends on this application" % item["package"])
                 elif item["type"] == "system":
                     exclude.append(item["package"])
+        txn = packages.Transaction()
         for item in self.dependencies:
             if item["type"] == "system" and not item["package"] in exclude:
                 if item.has_key("daemon") and item["daemon"]:
                     services.stop(item["daemon"])
                     services.disable(item["daemon"])
-                packages.remove([item["package"]], purge=config.get("apps", "purge", False))
+                txn.drop(item["package"])
+        if txn.remove:
+            with _install_lock:
+                status = txn.commit(purge=config.get("apps", "purge", False))
+            _dep_cache.clear()
+            for x in status:
+                if not status[x] in ["removed", "not installed"]:
+                    logger.warn("Failed to remove %s -- %s" % (x, status[x]))
         shutil.rmtree(os.path.join(config.get("apps", "app_dir"), self.id))
         storage.apps.remove("installed", self)
         regen_fw = False
@@ -141,51 +197,220 @@ class App:
         return data
 
 
+class DependencyGraph:
+    # App-to-app dependencies of the installed and available manifests,
+    # indexed in both directions. Traversals skip edges that close a cycle;
+    # cycles found while building are listed in self.cycles. Orderings are
+    # computed once per app and cached.
+    def __init__(self, installed=[], available=[]):
+        self.installed = set(x.id for x in installed)
+        self.deps, self.rdeps = {}, {}
+        self.cycles = []
+        self._cache = {}
+        manifests = dict([(x["id"], x.get("dependencies") or []) for x in available])
+        manifests.update(dict([(x.id, x.dependencies) for x in installed]))
+        for x in sorted(manifests):
+            self.deps.setdefault(x, [])
+            self.rdeps.setdefault(x, [])
+            for dep in manifests[x]:
+                if dep["type"] == "app" and not dep["package"] in self.deps[x]:
+                    self.deps[x].append(dep["package"])
+                    self.deps.setdefault(dep["package"], [])
+                    self.rdeps.setdefault(dep["package"], []).append(x)
+        self._find_cycles()
+
+    def requires(self, id):
+        # Everything id depends on, directly or not, dependencies first
+        return self._order(id, self.deps, "requires")
+
+    def required_by(self, id):
+        # Everything depending on id, directly or not, dependents first
+        return self._order(id, self.rdeps, "required_by")
+
+    def install_order(self, id):
+        return [x for x in self.requires(id) if not x in self.installed]
+
+    def remove_order(self, id):
+        return [x for x in self.required_by(id) if x in self.installed]
+
+    def _order(self, id, edges, name):
+        # Iterative post-order walk, so each app appears once and after
+        # everything it leads to
+        if not (name, id) in self._cache:
+            order, seen = [], set([id])
+            stack = [(id, iter(edges.get(id, [])))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if not child in seen:
+                        seen.add(child)
+                        stack.append((child, iter(edges.get(child, []))))
+                        break
+                else:
+                    stack.pop()
+                    if node != id:
+                        order.append(node)
+            self._cache[(name, id)] = order
+        return list(self._cache[(name, id)])
+
+    def _find_cycles(self):
+        state, path = {}, []
+        for root in sorted(self.deps):
+            if root in state:
+                continue
+            state[root] = 1
+            path.append(root)
+            stack = [(root, iter(self.deps[root]))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if state.get(child) == 1:
+                        self.cycles.append(path[path.index(child):] + [child])
+                    elif not child in state:
+                        state[child] = 1
+                        path.append(child)
+                        stack.append((child, iter(self.deps[child])))
+                        break
+                else:
+                    stack.pop()
+                    path.pop()
+                    state[node] = 2
+
+
 def get(id=None, type=None, verify=True):
     data = storage.apps.get("installed")
     if not data:
-        data = scan(verify)
+        data = restore() or scan(verify)
     if id or type:
-        tlist = []
-        for x in data:
-            if x.id == id:
-                return x
-            elif x.type == type:
-                tlist.append(x)
-        if tlist:
-            return tlist
-        return None
+        app = storage.apps.get("installed", id) if id else None
+        if app:
+            return app
+        return storage.apps.get_by("installed", "type", type) or None
     return data
 
 def scan(verify=True):
-    apps = []
-    applist = [app for app in os.listdir(config.get("apps", "app_dir")) if not app.startswith(".")]
-
-    for app in applist:
-        try:
-            with open(os.path.join(config.get("apps", "app_dir"), app, "manifest.json"), "r") as f:
-                data = json.loads(f.read())
-        except ValueError:
-            logger.warn("Failed to load %s due to a JSON parsing error" % app)
-            continue
-        logger.debug(" *** Loading %s" % data["id"])
-        a = App(**data)
-        a.load()
-        apps.append(a)
+    # Manifests are read and parsed concurrently and module imports are
+    # deferred until first use; dependency checks run in the same pool,
+    # sharing one result cache so common packages are only queried once
+    start = time.time()
+    app_dir = config.get("apps", "app_dir")
+    applist = [app for app in os.listdir(app_dir) if not app.startswith(".")]
+    _dep_cache.clear()
+    pool = ThreadPool(max(min(int(config.get("apps", "scan_threads", 8)), len(applist)), 1))
+    try:
+        apps = [x for x in pool.map(_read_manifest, applist) if x]
+        for a in apps:
+            logger.debug(" *** Loading %s" % a.id)
+            a.load(verify=False, imports=False)
+        if verify:
+            # One pacman transaction for the missing packages of every app
+            ok = [x for x in apps if not x.error]
+            status = install_system(sorted(set(sum(pool.map(App.get_missing, ok), []))))
+            pool.map(lambda x: _verify_app(x, status), ok)
+    finally:
+        pool.close()
+        pool.join()
+    for a in apps:
+        logger.debug(" *** %s: %s" % (a.id, ", ".join("%s %.3fs" % (x, a._timings[x])
+            for x in sorted(a._timings))))
+    logger.debug(" *** Scanned %s apps in %.3fs" % (len(apps), time.time() - start))
     storage.apps.set("installed", apps)
+    storage.save_snapshot("applications", [x.as_dict() for x in apps], _watch())
     #if verify:
         #verify_app_dependencies()
     return storage.apps.get("installed")
 
+def _read_manifest(app):
+    start = time.time()
+    try:
+        with open(os.path.join(config.get("apps", "app_dir"), app, "manifest.json"), "r") as f:
+            data = json.loads(f.read())
+    except ValueError:
+        logger.warn("Failed to load %s due to a JSON parsing error" % app)
+        return None
+    a = App(**data)
+    a._timings["manifest"] = time.time() - start
+    return a
+
+def _verify_app(app, status=None):
+    try:
+        app.verify_dependencies(status)
+    except Exception, e:
+        app.loadable = False
+        app.error = "Module error: %s" % str(e)
+        logger.warn("Failed to load %s -- %s" % (app.name, str(e)))
+
+def get_timings(id=None):
+    # Per-app load timings in seconds from the last scan, by phase
+    # (manifest, load, verify, modules)
+    if id:
+        app = storage.apps.get("installed", id)
+        return dict(app._timings) if app else None
+    return dict([(x.id, dict(x._timings)) for x in storage.apps.get("installed")])
+
+def restore():
+    # Rebuild installed apps from the last scan if no manifest changed since;
+    # dependency verification results are reused instead of rerun
+    data = storage.load_snapshot("applications", _watch())
+    if not data:
+        return None
+    apps = []
+    for x in data:
+        logger.debug(" *** Restoring %s" % x["id"])
+        a = App(**x)
+        a.load(verify=False, imports=False)
+        if not a.error:
+            a.loadable, a.error = x["loadable"], x["error"]
+        apps.append(a)
+    storage.apps.set("installed", apps)
+    return storage.apps.get("installed")
+
+def _watch():
+    app_dir = config.get("apps", "app_dir")
+    return [app_dir] + sorted(glob.glob(os.path.join(app_dir, "*", "manifest.json")))
+
+def install_system(pkgs):
+    # Installs system packages in a single pacman transaction and returns
+    # the status of each, see packages.Transaction
+    if not pkgs:
+        return {}
+    logger.debug(" *** Installing %s..." % ", ".join(pkgs))
+    try:
+        with _install_lock:
+            status = packages.Transaction(install=pkgs).commit()
+    except Exception, e:
+        logger.warn("Failed to install %s -- %s" % (", ".join(pkgs), str(e)))
+        status = dict([(x, "failed") for x in pkgs])
+    _dep_cache.clear()
+    for x in status:
+        if not status[x] in ["installed", "already installed"]:
+            logger.warn("Failed to install %s -- %s" % (x, status[x]))
+    return status
+
+def _dep_check(key, fn, *args):
+    # Memoizes dependency checks for the duration of a scan; cleared
+    # whenever something gets installed
+    with _dep_lock:
+        if key in _dep_cache:
+            return _dep_cache[key]
+    result = fn(*args)
+    with _dep_lock:
+        _dep_cache[key] = result
+    return result
+
+def _importable(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
 def get_available(id=None):
     data = storage.apps.get("available")
     if not data:
         data = scan_available()
     if id:
-        for x in data:
-            if x["id"] == id:
-                return x
-        return None
+        return storage.apps.get("available", id)
     return data
 
 def scan_available():
@@ -241,66 +466,147 @@ def verify_app_dependencies():
                         z.error = "Depends on %s, which cannot be loaded because %s failed to load" % (x.name,dep["name"])
 
 def get_dependent(id, op):
-    metoo = []
+    # Apps to install before id, dependencies first, or installed apps to
+    # remove along with id, dependents first
+    if op == "install":
+        return get_graph(available=True).install_order(id)
+    return get_graph().remove_order(id)
+
+def get_graph(available=False):
+    # The graph is rebuilt only when the installed or available lists change
+    global _graph, _graph_key
     inst = storage.apps.get("installed") or get()
-    avail = storage.apps.get("available") or get_available()
-    if op == 'remove':
-        for i in inst:
-            for dep in i.dependencies:
-                if dep['type'] == 'app' and dep['package'] == id:
-                    metoo.append(i)
-                    metoo += get_dependent(i.id, 'remove')
-    elif op == 'install':
-        i = next(x for x in avail if x["id"] == id)
-        for dep in i["dependencies"]:
-            if dep["type"] == 'app' and dep['package'] not in [x["pid"] for x in inst]:
-                metoo.append(dep['package'])
-                metoo += get_dependent(dep['package'], 'install')
-    return metoo
+    avail = storage.apps.get("available") or (get_available() if available else [])
+    key = storage.apps.generation
+    with _graph_lock:
+        if key != _graph_key:
+            _graph = DependencyGraph(inst, avail or [])
+            _graph_key = key
+            for x in _graph.cycles:
+                logger.warn("Dependency cycle between applications: %s" % " -> ".join(x))
+        return _graph
 
 def install(id, install_deps=True, load=True, message=DefaultMessage()):
-    deps = get_dependent(id, "install")
-    if install_deps and deps:
-        if message:
-            message.update("info", "Installing dependencies for %s..." % id)
-        for x in deps:
-            try:
-                _install(x, load=load)
-            except Exception, e:
-                if message:
-                    message.complete("error", str(e))
-                    return
-                else:
-                    raise
+    deps = get_dependent(id, "install") if install_deps else []
     if message:
-        message.update("info", "Installing %s..." % id)
+        if deps:
+            message.update("info", "Installing dependencies for %s..." % id)
+        else:
+            message.update("info", "Installing %s..." % id)
     try:
-        _install(id, load=load)
+        fetch(deps + [id])
+        stack = [_add(x, load=False) for x in deps + [id]]
     except Exception, e:
         if message:
             message.complete("error", str(e))
             return
         else:
             raise
+    if load:
+        # System packages for the whole stack go in one pacman transaction
+        status = install_system(sorted(set(sum([x.get_missing() for x in stack], []))))
+        for x in stack:
+            x.load(status=status)
     a = get(id)
     for x in a.services:
         if x["ports"]:
             regen_fw = True
             tracked_services.register(a.id, x["binary"], x["name"], a.icon, x["ports"])
 
-def _install(id, load=True):
-    data = api('https://%s/apps/%s' % (config.get("general", "repo_server"), id), crit=True)
-    if data['status'] == 200:
-        with open(os.path.join(config.get("apps", "app_dir"), 'plugin.tar.gz'), 'wb') as f:
-            f.write(base64.b64decode(data['info']))
-    else:
-        raise Exception('Application retrieval failed - %s' % str(data['info']))
-    with tarfile.open(os.path.join(config.get("apps", "app_dir"), 'plugin.tar.gz'), 'r:gz') as t:
-        t.extractall(config.get("apps", "app_dir"))
-    os.unlink(os.path.join(config.get("apps", "app_dir"), 'plugin.tar.gz'))
+def fetch(ids):
+    # Downloads and unpacks several apps at once, up to apps.download_threads
+    # at a time; raises the first failure once every download has finished
+    pool = ThreadPool(max(min(int(config.get("apps", "download_threads", 4)), len(ids)), 1))
+    try:
+        errors = pool.map(_fetch_safe, ids)
+    finally:
+        pool.close()
+        pool.join()
+    for x in errors:
+        if x:
+            raise x
+
+def _fetch_safe(id):
+    try:
+        _fetch(id)
+    except Exception, e:
+        return e
+
+def _fetch(id):
+    # The package arrives base64-encoded inside a JSON response; it is
+    # decoded as it streams into the artifact cache, which is skipped
+    # entirely when this version was fetched before. It is untarred into a
+    # staging directory that replaces the app's directory once complete.
+    # The cache only links the version to the package once it has
+    # extracted, and drops it if it does not
+    app_dir = config.get("apps", "app_dir")
+    url = 'https://%s/apps/%s' % (config.get("general", "repo_server"), id)
+    avail = storage.apps.get("available", id) or {}
+    version = avail.get("version")
+    cache = artifacts.get_cache()
+    stage = os.path.join(app_dir, ".%s.partial" % id)
+    if os.path.exists(stage):
+        shutil.rmtree(stage)
+    os.makedirs(stage)
+    try:
+        path = cache.get(url, version, avail.get("sha256"))
+        if not path:
+            path = _download(id, url, version, avail.get("sha256"))
+        try:
+            with tarfile.open(path, "r:gz") as t:
+                t.extractall(stage)
+            if not os.path.isdir(os.path.join(stage, id)):
+                raise Exception("package does not contain %s" % id)
+        except Exception, e:
+            cache.discard(path, url, version)
+            raise Exception('Application retrieval failed - %s' % str(e))
+        cache.bind(url, version, path)
+        if os.path.exists(os.path.join(app_dir, id)):
+            shutil.rmtree(os.path.join(app_dir, id))
+        os.rename(os.path.join(stage, id), os.path.join(app_dir, id))
+    finally:
+        shutil.rmtree(stage, ignore_errors=True)
+
+def _download(id, url, version, sha256):
+    cache = artifacts.get_cache()
+    try:
+        resp = urllib2.urlopen(url)
+    except Exception, e:
+        raise Exception('Application retrieval failed - %s' % str(e))
+    reader = JSONBase64Reader(resp, "info")
+    path, error = None, None
+    try:
+        path = cache.put(reader, url, version, sha256, bind=False)
+    except Exception, e:
+        error = str(e)
+    finally:
+        data = reader.document() or {}
+        resp.close()
+    if data.get("status") != 200:
+        if path:
+            cache.discard(path)
+        raise Exception('Application retrieval failed - %s' % str(data.get("info") or error
+            or "server returned status %s" % data.get("status")))
+    if error:
+        raise Exception('Application retrieval failed - %s' % error)
+    logger.debug(" *** Fetched %s (%s)" % (id, os.path.basename(path)))
+    return path
+
+def _add(id, load=True):
     with open(os.path.join(config.get("apps", "app_dir"), id, "manifest.json")) as f:
         data = json.loads(f.read())
     app = App(**data)
     if load:
         app.load()
+    # A reinstall or upgrade replaces the entry for the old manifest
+    while storage.apps.get("installed", id):
+        storage.apps.remove("installed", storage.apps.get("installed", id))
     storage.apps.add("installed", app)
+    return app
+
+_dep_cache = {}
+_dep_lock = threading.Lock()
+_install_lock = threading.Lock()
+_graph = None
+_graph_key = None
+_graph_lock = threading.Lock()
@@ -0,0 +1,189 @@
+import hashlib
+import os
+import tempfile
+import threading
+import urllib2
+
+from arkos import config, logger
+
+CHUNK = 65536
+
+
+class ArtifactCache:
+    # Content-addressed store for downloaded packages. Blobs are kept under
+    # blobs/<sha256>, and keys/<sha1 of url and version> records which blob
+    # a URL resolved to at that version, so an unversioned URL is never
+    # served from cache. Blobs are rehashed before every use, and the least
+    # recently used are evicted once the store grows past max_size. An
+    # optional mirror directory with the same layout (a shared or peer
+    # cache) is tried before the network.
+    def __init__(self, path, max_size=2*1024**3, mirror=None):
+        self.path = path
+        self.max_size = max_size
+        self.mirror = mirror
+        self._lock = threading.Lock()
+        for x in ["blobs", "keys"]:
+            if not os.path.exists(os.path.join(path, x)):
+                os.makedirs(os.path.join(path, x))
+
+    def get(self, url=None, version=None, sha256=None):
+        # Returns the path of a verified cached blob, or None
+        digest = sha256 or self._lookup(self.path, url, version)
+        if digest:
+            path = self._blob(self.path, digest)
+            if self._verify(path, digest):
+                os.utime(path, None)
+                self._bind(url, version, digest)
+                return path
+        if self.mirror:
+            digest = sha256 or self._lookup(self.mirror, url, version)
+            path = self._blob(self.mirror, digest) if digest else None
+            if path and os.path.exists(path):
+                try:
+                    with open(path, "rb") as f:
+                        return self.put(f, url, version, digest)
+                except (IOError, ValueError), e:
+                    logger.warn("Ignoring mirrored artifact %s -- %s" % (digest, str(e)))
+        return None
+
+    def put(self, fileobj, url=None, version=None, sha256=None, bind=True):
+        # Streams fileobj into the store and returns the blob's path;
+        # raises ValueError if the content does not match sha256. With
+        # bind=False the URL is not linked to the blob until bind() is
+        # called, so callers can check that the download is usable first
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+        h = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    data = fileobj.read(CHUNK)
+                    if not data:
+                        break
+                    h.update(data)
+                    f.write(data)
+            digest = h.hexdigest()
+            if sha256 and digest != sha256:
+                raise ValueError("Checksum mismatch: expected %s, got %s" % (sha256, digest))
+            os.rename(tmp, self._blob(self.path, digest))
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        if bind:
+            self._bind(url, version, digest)
+        self.evict(keep=digest)
+        return self._blob(self.path, digest)
+
+    def fetch(self, url, version=None, sha256=None, bind=True):
+        # Cached blob for url, downloading it first if need be
+        path = self.get(url, version, sha256)
+        if path:
+            logger.debug(" *** Using cached artifact for %s" % url)
+            return path
+        resp = urllib2.urlopen(url)
+        try:
+            return self.put(resp, url, version, sha256, bind)
+        finally:
+            resp.close()
+
+    def bind(self, url, version, path):
+        self._bind(url, version, os.path.basename(path))
+
+    def discard(self, path, url=None, version=None):
+        # Drops a blob that turned out to be unusable, along with the key
+        # for url at version, so the next attempt goes back to the network
+        if url and version and self._lookup(self.path, url, version) == os.path.basename(path):
+            try:
+                os.unlink(os.path.join(self.path, "keys", _key(url, version)))
+            except OSError:
+                pass
+        if os.path.dirname(path) == os.path.join(self.path, "blobs") and os.path.exists(path):
+            os.unlink(path)
+
+    def evict(self, keep=None):
+        with self._lock:
+            blobs, total = [], 0
+            for x in os.listdir(os.path.join(self.path, "blobs")):
+                try:
+                    st = os.stat(self._blob(self.path, x))
+                except OSError:
+                    continue
+                blobs.append((st.st_mtime, st.st_size, x))
+                total += st.st_size
+            evicted = False
+            for mtime, size, x in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                if x == keep:
+                    continue
+                try:
+                    os.unlink(self._blob(self.path, x))
+                except OSError:
+                    pass
+                total -= size
+                evicted = True
+            if evicted:
+                self._prune_keys()
+
+    def _lookup(self, path, url, version):
+        if not url or not version:
+            return None
+        try:
+            with open(os.path.join(path, "keys", _key(url, version)), "r") as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+
+    def _bind(self, url, version, digest):
+        if not url or not version or self._lookup(self.path, url, version) == digest:
+            return
+        path = os.path.join(self.path, "keys", _key(url, version))
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(digest)
+        os.rename(tmp, path)
+
+    def _verify(self, path, digest):
+        h = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(CHUNK), ""):
+                    h.update(data)
+        except IOError:
+            return False
+        if h.hexdigest() != digest:
+            logger.warn("Discarding corrupt cached artifact %s" % digest)
+            os.unlink(path)
+            return False
+        return True
+
+    def _prune_keys(self):
+        keys = os.path.join(self.path, "keys")
+        for x in os.listdir(keys):
+            try:
+                with open(os.path.join(keys, x), "r") as f:
+                    digest = f.read().strip()
+                if not os.path.exists(self._blob(self.path, digest)):
+                    os.unlink(os.path.join(keys, x))
+            except (IOError, OSError):
+                pass
+
+    def _blob(self, path, digest):
+        return os.path.join(path, "blobs", digest)
+
+
+def _key(url, version):
+    return hashlib.sha1("%s\n%s" % (url, version)).hexdigest()
+
+def get_cache():
+    global cache
+    with _cache_lock:
+        if not cache:
+            cache = ArtifactCache(
+                os.path.join(config.get("general", "cache_dir", "/var/cache/arkos"), "artifacts"),
+                int(config.get("artifacts", "max_size", 2*1024**3)),
+                config.get("artifacts", "mirror"))
+        return cache
+
+
+cache = None
+_cache_lock = threading.Lock()
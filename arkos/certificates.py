@@ -7,10 +7,7 @@ import os
 from arkos import config, storage
 from system import systemtime, groups
 
-
-if not groups.get_system("ssl-cert"):
-    groups.SystemGroup("ssl-cert").add()
-gid = groups.get_system("ssl-cert").gid
+gid = None
 
 
 class Certificate:
@@ -113,12 +110,13 @@ class CertificateAuthority:
 def get(id=None):
     data = storage.certs.get("certificates")
     if not data:
-        data = scan()
+        data = storage.load_snapshot("certificates", _watch())
+        if data:
+            storage.certs.set("certificates", data)
+        else:
+            data = scan()
     if id:
-        for x in data:
-            if x.id == id:
-                return x
-        return None
+        return storage.certs.get("certificates", id)
     return data
 
 def scan():
@@ -143,17 +141,19 @@ def scan():
             sha1=sha1, md5=md5)
         certs.append(c)
     storage.certs.set("certificates", certs)
+    storage.save_snapshot("certificates", certs, _watch())
     return certs
 
 def get_authorities(id=None):
     data = storage.certs.get("authorities")
     if not data:
-        data = scan_authorities()
+        data = storage.load_snapshot("authorities", _watch_authorities())
+        if data:
+            storage.certs.set("authorities", data)
+        else:
+            data = scan_authorities()
     if id:
-        for x in data:
-            if x.id == id:
-                return x
-        return None
+        return storage.certs.get("authorities", id)
     return data
 
 def scan_authorities():
@@ -166,6 +166,7 @@ def scan_authorities():
             key_path=os.path.join(config.get("certificates", "ca_key_dir"), id+'.key'))
         certs.append(ca)
     storage.certs.set("authorities", certs)
+    storage.save_snapshot("authorities", certs, _watch_authorities())
     return certs
 
 def upload_certificate(id, cert, key, chain=''):
@@ -193,9 +194,9 @@ def upload_certificate(id, cert, key, chain=''):
     with open(c.key_path, 'w') as f:
         f.write(key)
 
-    os.chown(c.cert_path, -1, gid)
+    os.chown(c.cert_path, -1, get_gid())
     os.chmod(c.cert_path, 0660)
-    os.chown(c.key_path, -1, gid)
+    os.chown(c.key_path, -1, get_gid())
     os.chmod(c.key_path, 0660)
     storage.certs.add("certificates", c)
     return c
@@ -242,12 +243,12 @@ def generate_certificate(
 
     with open(cert_path, "wt") as f:
         f.write(OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, crt))
-    os.chown(cert_path, -1, gid)
+    os.chown(cert_path, -1, get_gid())
     os.chmod(cert_path, 0660)
 
     with open(key_path, "wt") as f:
         f.write(OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM, key))
-    os.chown(key_path, -1, gid)
+    os.chown(key_path, -1, get_gid())
     os.chmod(key_path, 0660)
     
     sha1, md5 = get_cert_hashes(crt)
@@ -288,6 +289,27 @@ def generate_authority(domain):
     storage.certs.add("authorities", ca)
     return ca
 
+def get_gid():
+    # The ssl-cert group is created the first time a key is written, not on import
+    global gid
+    if gid is None:
+        if not groups.get_system("ssl-cert"):
+            groups.SystemGroup("ssl-cert").add()
+        gid = groups.get_system("ssl-cert").gid
+    return gid
+
+def _watch():
+    # Files are watched too, so a renewal written over the same path is seen
+    cert_dir, key_dir = config.get("certificates", "cert_dir"), config.get("certificates", "key_dir")
+    return [cert_dir, key_dir, getattr(config, "filename", "")] \
+        + sorted(glob.glob(os.path.join(cert_dir, "*.crt"))) \
+        + sorted(glob.glob(os.path.join(key_dir, "*.key")))
+
+def _watch_authorities():
+    cert_dir, key_dir = config.get("certificates", "ca_cert_dir"), config.get("certificates", "ca_key_dir")
+    return [cert_dir, key_dir] + sorted(glob.glob(os.path.join(cert_dir, "*.pem"))) \
+        + sorted(glob.glob(os.path.join(key_dir, "*.key")))
+
 def get_cert_hashes(cert):
     h, m = hashlib.sha1(), hashlib.md5()
     h.update(OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_ASN1, cert))
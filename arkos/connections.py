@@ -1,21 +1,191 @@
+import contextlib
 import json
-import ldap
-import ldap.modlist
 import os
 import sys
-import xmlrpclib
-
-from dbus import SystemBus, Interface
+import threading
+import time
 
 
 class ConnectionsManager:
     def __init__(self, config):
-        self.LDAP = ldap_connect(config=config)
-        self.SystemD = systemd_connect()
-        self.Supervisor = supervisor_connect()
+        self.config = config
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        # Backends connect on first use, so importing arkos costs nothing
+        if not name in CONNECTORS:
+            raise AttributeError(name)
+        with self._lock:
+            if not name in self.__dict__:
+                self.__dict__[name] = CONNECTORS[name](self.config)
+        return self.__dict__[name]
+
+    def is_connected(self, name):
+        return name in self.__dict__
+
+
+class LDAPPool:
+    # Hands out a bound connection per operation, so concurrent callers
+    # don't serialize on one handle. Connections that were idle for longer
+    # than idle_check are probed before reuse; a connection that reports
+    # SERVER_DOWN is thrown away and the operation retried on a fresh bind.
+    def __init__(self, config, size=4, idle_check=30):
+        self.config = config
+        self.size = size
+        self.idle_check = idle_check
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            import ldap
+            for attempt in range(2):
+                c = self.checkout()
+                try:
+                    r = getattr(c, name)(*args, **kwargs)
+                except ldap.SERVER_DOWN:
+                    self.discard(c)
+                    if attempt:
+                        raise
+                    continue
+                except:
+                    self.checkin(c)
+                    raise
+                self.checkin(c)
+                return r
+        return call
+
+    @contextlib.contextmanager
+    def connection(self):
+        # For sequences that must share a handle, e.g. async calls and their results
+        import ldap
+        c = self.checkout()
+        try:
+            yield c
+        except ldap.SERVER_DOWN:
+            self.discard(c)
+            raise
+        except:
+            self.checkin(c)
+            raise
+        self.checkin(c)
+
+    def paged_search(self, base, scope, filterstr="(objectClass=*)", attrlist=None,
+            page_size=500):
+        # Yields entries as each page arrives, using the Simple Paged Results
+        # control, so large directories never sit in memory all at once
+        from ldap.controls import SimplePagedResultsControl
+        ctrl = SimplePagedResultsControl(True, size=page_size, cookie="")
+        with self.connection() as c:
+            while True:
+                msgid = c.search_ext(base, scope, filterstr, attrlist,
+                    serverctrls=[ctrl])
+                rtype, rdata, rmsgid, sctrls = c.result3(msgid)
+                for x in rdata:
+                    yield x
+                cookie = None
+                for x in sctrls:
+                    if x.controlType == SimplePagedResultsControl.controlType:
+                        cookie = x.cookie
+                if not cookie:
+                    break
+                ctrl.cookie = cookie
+
+    def checkout(self):
+        with self._cond:
+            while not self._idle and self._open >= self.size:
+                self._cond.wait()
+            if self._idle:
+                c, used = self._idle.pop()
+            else:
+                c, used = None, 0
+                self._open += 1
+        if c and time.time() - used > self.idle_check and not self._healthy(c):
+            self._close(c)
+            c = None
+        if not c:
+            try:
+                c = ldap_connect(config=self.config)
+            except:
+                with self._cond:
+                    self._open -= 1
+                    self._cond.notify()
+                raise
+        return c
+
+    def checkin(self, c):
+        with self._cond:
+            self._idle.append((c, time.time()))
+            self._cond.notify()
+
+    def discard(self, c):
+        self._close(c)
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for c, used in idle:
+            self._close(c)
+
+    def _healthy(self, c):
+        try:
+            c.whoami_s()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, c):
+        try:
+            c.unbind_s()
+        except Exception:
+            pass
+
+
+class SupervisorConnection:
+    # Proxies the supervisor.* XML-RPC namespace. Each thread gets its own
+    # ServerProxy, whose transport keeps its HTTP/1.1 connection open
+    # between calls instead of reconnecting every time.
+    def __init__(self, uri):
+        self.uri = uri
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._proxy().supervisor, name)
+
+    def multicall(self, calls):
+        # Runs [(method, args), ...] in one system.multicall request. Faults
+        # are returned in place of the failed call's result, not raised
+        import xmlrpclib
+        mc = xmlrpclib.MultiCall(self._proxy())
+        for method, args in calls:
+            getattr(mc.supervisor, method)(*args)
+        results = []
+        r = mc()
+        for i in range(len(calls)):
+            try:
+                results.append(r[i])
+            except xmlrpclib.Fault, e:
+                results.append(e)
+        return results
+
+    def _proxy(self):
+        import xmlrpclib
+        if not hasattr(self._local, "proxy"):
+            self._local.proxy = xmlrpclib.ServerProxy(self.uri)
+        return self._local.proxy
 
 
 def ldap_connect(uri="", rootdn="", dn="cn=admin", config=None, passwd=""):
+    import ldap
     if not all([uri, rootdn, dn]) and not config:
         raise Exception("No configuration values passed")
     uri = uri or config.get("general", "ldap_uri", "ldap://localhost")
@@ -44,10 +214,23 @@ def ldap_connect(uri="", rootdn="", dn="cn=admin", config=None, passwd=""):
     return c
 
 def systemd_connect():
+    from dbus import SystemBus, Interface
     bus = SystemBus()
     systemd = bus.get_object("org.freedesktop.systemd1", "/org/freedesktop/systemd1")
     return Interface(systemd, dbus_interface="org.freedesktop.systemd1.Manager")
 
+def systemd_unit_properties(path):
+    from dbus import SystemBus, Interface
+    unit = SystemBus().get_object("org.freedesktop.systemd1", path)
+    return Interface(unit, dbus_interface="org.freedesktop.DBus.Properties")
+
 def supervisor_connect():
-    s = xmlrpclib.Server("http://localhost:9001/RPC2")
-    return s.supervisor
+    return SupervisorConnection("http://localhost:9001/RPC2")
+
+
+CONNECTORS = {
+    "LDAP": lambda config: LDAPPool(config,
+        size=int(config.get("general", "ldap_pool_size", 4))),
+    "SystemD": lambda config: systemd_connect(),
+    "Supervisor": lambda config: supervisor_connect()
+}
@@ -111,15 +111,10 @@ def get(id=None, type=None):
     if not data:
         data = scan()
     if id or type:
-        tlist = []
-        for x in data:
-            if x.id == id:
-                return x
-            elif x.manager.id == type:
-                tlist.append(x)
-        if tlist:
-            return tlist
-        return None
+        item = storage.dbs.get("databases", id) if id else None
+        if item:
+            return item
+        return storage.dbs.get_by("databases", "manager.id", type) or None
     return data
 
 def scan():
@@ -135,15 +130,10 @@ def get_user(id=None, type=None):
     if not data:
         data = scan_users()
     if id or type:
-        tlist = []
-        for x in data:
-            if x.id == id:
-                return x
-            elif x.manager.id == type:
-                tlist.append(x)
-        if tlist:
-            return tlist
-        return None
+        item = storage.dbs.get("users", id) if id else None
+        if item:
+            return item
+        return storage.dbs.get_by("users", "manager.id", type) or None
     return data
 
 def scan_users():
@@ -159,10 +149,7 @@ def get_managers(id=None):
     if not data:
         data = scan_managers()
     if id:
-        for x in data:
-            if x.id == id:
-                return x
-        return None
+        return storage.dbs.get("managers", id)
     return data
 
 def scan_managers():
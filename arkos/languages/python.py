@@ -1,7 +1,11 @@
 import os
+import site
 import stat
 import shutil
 
+from distutils.sysconfig import get_python_lib
+
+from arkos.system.packages import PackageIndex
 from arkos.utilities import shell
 
 
@@ -17,9 +21,27 @@ def remove(self, *mods):
         self.app.log.error('Failed to remove %s via PyPI; %s'%(' '.join(x for x in mods),s["stderr"]))
         raise Exception('Failed to remove %s via PyPI, check logs for info'%' '.join(x for x in mods))
 
-def is_installed(self, name):
-    s = shell('pip freeze')
-    for x in s["stdout"].split('\n'):
-        if name.lower() in x.split('==')[0].lower():
-            return True
-    return False
+def is_installed(name):
+    return name in index
+
+def _site_dirs():
+    dirs = [get_python_lib(), get_python_lib(plat_specific=True)]
+    if hasattr(site, "getsitepackages"):
+        dirs += site.getsitepackages()
+    dirs.append(site.USER_SITE)
+    return sorted(set(x for x in dirs if x))
+
+def _read_site_packages(paths):
+    # Distributions are recorded as Name-version.dist-info or
+    # Name-version[-pyX.Y].egg-info, with "-" in names escaped as "_"
+    for path in paths:
+        if os.path.isdir(path):
+            for x in os.listdir(path):
+                if x.endswith(".dist-info") or x.endswith(".egg-info"):
+                    yield _normalize(x.split("-", 1)[0])
+
+def _normalize(name):
+    return name.lower().replace("_", "-")
+
+
+index = PackageIndex(_site_dirs(), _read_site_packages, _normalize)
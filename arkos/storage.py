@@ -1,37 +1,155 @@
+import cPickle
+import os
+import stat
+
+
 class Storage:
-    def __init__(self, types=[]):
+    def __init__(self, types=[], indexes=[]):
+        self._indexes = indexes
+        self._keyed = {}
+        self._by = {}
+        self._keys = {}
+        # Bumped on every change to any list, so callers can cache
+        # structures derived from it
+        self.generation = 0
         for x in types:
-            setattr(self, x, [])
-    
+            self.set(x, [])
+
     def add(self, stype, item):
         storage = getattr(self, stype)
         storage.append(item)
-    
+        self._index(stype, item)
+        self.generation += 1
+
     def set(self, stype, items):
         setattr(self, stype, items)
+        self._keyed[stype] = {}
+        self._by[stype] = dict([(x, {}) for x in self._indexes])
+        self._keys[stype] = {}
+        for x in items:
+            self._index(stype, x)
+        self.generation += 1
 
     def get(self, stype, id=None):
         storage = getattr(self, stype)
         if id:
-            for x in storage:
-                if id == x.id:
-                    return x
-            return None
+            return self._keyed[stype].get(id)
         return storage
-    
+
+    def get_by(self, stype, key, value):
+        # Secondary index lookup, e.g. get_by("databases", "manager.id", "mysql")
+        if key == "id":
+            item = self._keyed[stype].get(value)
+            return [item] if item else []
+        return list(self._by[stype][key].get(value, []))
+
     def get_keyed(self, stype, id=None):
-        items = {}
-        storage = getattr(self, stype)
-        for x in storage:
-            items[x.id] = x
-        return items
-    
+        # Returns the live index; callers must not modify it
+        return self._keyed[stype]
+
     def remove(self, stype, item):
         storage = getattr(self, stype)
         if type(item) == str:
-            for x in storage:
-                if item == x.id:
-                    storage.remove(x)
-                    return
+            item = self._keyed[stype].get(item)
+            if not item:
+                return
+        storage.remove(item)
+        self._unindex(stype, item)
+        self.generation += 1
+
+    def reindex(self, stype, item):
+        # Call after changing an indexed attribute of a stored item
+        self._unindex(stype, item)
+        self._index(stype, item)
+        self.generation += 1
+
+    def _index(self, stype, item):
+        # Keys are recorded per item so a later reindex can find old buckets.
+        # The id index keeps the first item added under a key, like a scan would
+        keys = dict([(x, _getkey(item, x)) for x in ["id"] + self._indexes])
+        self._keys[stype][id(item)] = keys
+        if keys["id"] is not None:
+            self._keyed[stype].setdefault(keys["id"], item)
+        for x in self._indexes:
+            if keys[x] is not None:
+                self._by[stype][x].setdefault(keys[x], []).append(item)
+
+    def _unindex(self, stype, item):
+        keys = self._keys[stype].pop(id(item), None)
+        if not keys:
+            return
+        if keys["id"] is not None and self._keyed[stype].get(keys["id"]) is item:
+            del self._keyed[stype][keys["id"]]
+            for x in getattr(self, stype):
+                if x is not item and _getkey(x, "id") == keys["id"]:
+                    self._keyed[stype][keys["id"]] = x
+                    break
+        for x in self._indexes:
+            bucket = self._by[stype][x].get(keys[x])
+            if not bucket:
+                continue
+            for i, y in enumerate(bucket):
+                if y is item:
+                    del bucket[i]
+                    break
+            if not bucket:
+                del self._by[stype][x][keys[x]]
+
+
+def _getkey(item, key):
+    # Resolve dotted attribute paths ("manager.id") on objects or dicts
+    for x in key.split("."):
+        if item is None:
+            return None
+        if isinstance(item, dict):
+            item = item.get(x)
         else:
-            storage.remove(item)
+            item = getattr(item, x, None)
+    try:
+        hash(item)
+    except TypeError:
+        return None
+    return item
+
+
+SNAPSHOT_VERSION = 1
+
+
+def signature(watch=[]):
+    # Directories are fingerprinted by mtime and entry count, files by mtime and size
+    sig = []
+    for x in watch:
+        try:
+            st = os.stat(x)
+        except OSError:
+            sig.append((x, None, None))
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            sig.append((x, st.st_mtime, len(os.listdir(x))))
+        else:
+            sig.append((x, st.st_mtime, st.st_size))
+    return sig
+
+def save_snapshot(path, data, watch=[]):
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + ".tmp", "wb") as f:
+            cPickle.dump((SNAPSHOT_VERSION, signature(watch), data), f,
+                cPickle.HIGHEST_PROTOCOL)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError, cPickle.PicklingError, TypeError):
+        if os.path.exists(path + ".tmp"):
+            os.unlink(path + ".tmp")
+        return False
+    return True
+
+def load_snapshot(path, watch=[]):
+    try:
+        with open(path, "rb") as f:
+            version, sig, data = cPickle.load(f)
+    except Exception:
+        return None
+    if version != SNAPSHOT_VERSION or sig != signature(watch):
+        return None
+    return data
@@ -2,10 +2,12 @@ import network
 import packages
 import services
 import stats
+import metrics
 import systemtime
 import domains
 import users
 import groups
+import ids
 import filesystems
 
 
@@ -14,9 +16,11 @@ __all__ = [
     "packages",
     "services",
     "stats",
+    "metrics",
     "systemtime",
     "domains",
     "users",
     "groups",
+    "ids",
     "filesystems"
 ]
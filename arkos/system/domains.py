@@ -1,8 +1,9 @@
 import ldap
+import ldap.dn
+import ldap.filter
 import ldap.modlist
 
 from arkos import config, conns
-from arkos.system import users
 
 
 class Domain:
@@ -25,7 +26,9 @@ class Domain:
             ldap.modlist.addModlist(ldif))
     
     def remove(self):
-        if self.name in [x.domain for x in users.get()]:
+        if conns.LDAP.search_s("ou=users,%s" % self.rootdn, ldap.SCOPE_SUBTREE,
+                "(&(objectClass=inetOrgPerson)(mail=*@%s))" % ldap.filter.escape_filter_chars(self.name),
+                ["uid"], attrsonly=1):
             raise Exception("A user is still using this domain")
         conns.LDAP.delete_s("virtualdomain=%s,ou=domains,%s" % (self.name,self.rootdn))
 
@@ -34,12 +37,25 @@ class Domain:
 
 
 def get(id=None):
+    if id:
+        try:
+            qset = conns.LDAP.search_s("virtualdomain=%s,ou=domains,%s" % (ldap.dn.escape_dn_chars(id),
+                config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org")),
+                ldap.SCOPE_BASE, "(objectClass=mailDomain)", ["virtualdomain"])
+        except ldap.NO_SUCH_OBJECT:
+            return None
+        return _from_ldif(qset[0]) if qset else None
     results = []
     qset = conns.LDAP.search_s("ou=domains,%s" % config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org"),
         ldap.SCOPE_SUBTREE, "virtualdomain=*", ["virtualdomain"])
     for x in qset:
-        d = Domain(name=x[1]["virtualdomain"][0], rootdn=x[0].split("ou=domains,")[1])
-        if d.name == id:
-            return d
-        results.append(d)
+        results.append(_from_ldif(x))
     return results
+
+def iter_domains(page_size=500):
+    for x in conns.LDAP.paged_search("ou=domains,%s" % config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org"),
+            ldap.SCOPE_SUBTREE, "virtualdomain=*", ["virtualdomain"], page_size):
+        yield _from_ldif(x)
+
+def _from_ldif(x):
+    return Domain(name=x[1]["virtualdomain"][0], rootdn=x[0].split("ou=domains,")[1])
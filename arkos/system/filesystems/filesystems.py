@@ -264,16 +264,13 @@ def get_virtual_disks(name=None):
     return devs if not name else None
 
 def get_points(id=None, path=None):
-    points = storage.points.get("points")
     if id:
-        for x in points:
-            if x.name == id:
-                return x
+        points = storage.points.get_by("points", "name", id)
+        return points[0] if points else None
     elif path:
-        for x in points:
-            if x.path == path:
-                return x
-    return points
+        points = storage.points.get_by("points", "path", path)
+        return points[0] if points else None
+    return storage.points.get("points")
 
 def register_point(name, path, stype, icon="gen-storage"):
     p = PointOfInterest(name, path, stype, icon)
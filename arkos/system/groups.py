@@ -1,7 +1,11 @@
 import grp
 import ldap
+import ldap.dn
+import ldap.filter
 import ldap.modlist
 
+import ids
+
 from arkos import conns, config
 from arkos.utilities import shell
 
@@ -74,18 +78,35 @@ class SystemGroup:
 
 
 def get(gid=None):
+    gfilter = "(objectClass=posixGroup)"
+    if gid:
+        gfilter = "(&%s(gidNumber=%s))" % (gfilter, ldap.filter.escape_filter_chars(str(gid)))
     r = []
     for x in conns.LDAP.search_s("ou=groups,%s" % config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org"), 
-            ldap.SCOPE_SUBTREE, "(objectClass=posixGroup)", None):
-        for y in x[1]:
-            if type(x[1][y]) == list and len(x[1][y]) == 1 and y != "memberUid":
-                x[1][y] = x[1][y][0]
-        g = Group(name=x[1]["cn"], gid=int(x[1]["gidNumber"]), users=x[1].get("memberUid") or [],
-            rootdn=x[0].split("ou=groups,")[1])
-        if g.gid == gid:
-            return g
-        r.append(g)
-    return r if not gid else None
+            ldap.SCOPE_SUBTREE, gfilter, None):
+        r.append(_from_ldif(x))
+    return r if not gid else (r[0] if r else None)
+
+def get_by_name(name):
+    try:
+        qset = conns.LDAP.search_s("cn=%s,ou=groups,%s" % (ldap.dn.escape_dn_chars(name),
+            config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org")),
+            ldap.SCOPE_BASE, "(objectClass=posixGroup)", None)
+    except ldap.NO_SUCH_OBJECT:
+        return None
+    return _from_ldif(qset[0]) if qset else None
+
+def iter_groups(page_size=500):
+    for x in conns.LDAP.paged_search("ou=groups,%s" % config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org"), 
+            ldap.SCOPE_SUBTREE, "(objectClass=posixGroup)", None, page_size):
+        yield _from_ldif(x)
+
+def _from_ldif(x):
+    for y in x[1]:
+        if type(x[1][y]) == list and len(x[1][y]) == 1 and y != "memberUid":
+            x[1][y] = x[1][y][0]
+    return Group(name=x[1]["cn"], gid=int(x[1]["gidNumber"]), users=x[1].get("memberUid") or [],
+        rootdn=x[0].split("ou=groups,")[1])
 
 def get_system(gid=None):
     r = []
@@ -97,4 +118,19 @@ def get_system(gid=None):
     return r if not gid else None
 
 def get_next_gid():
-    return max([x.gid for x in get_system()]) + 1
+    return gids.allocate()
+
+def _seed_gid():
+    found = [x.gr_gid for x in grp.getgrall()]
+    found += ids.ldap_ids("ou=groups", "posixGroup", "gidNumber")
+    return max(found or [0])
+
+def _gid_in_use(gid):
+    try:
+        grp.getgrgid(gid)
+        return True
+    except KeyError:
+        return ids.ldap_in_use("ou=groups", "gidNumber", gid)
+
+
+gids = ids.IDAllocator("/etc/group", _seed_gid, _gid_in_use)
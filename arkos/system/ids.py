@@ -0,0 +1,62 @@
+import ldap
+import os
+import threading
+
+from arkos import conns, config
+
+
+class IDAllocator:
+    # Hands out increasing uid/gid numbers from a cached high-water mark.
+    # The mark is seeded once and reseeded whenever the local account
+    # database (/etc/passwd, /etc/group) changes on disk. LDAP adds from
+    # other processes change neither, so each number is also checked with
+    # in_use(n) before it is handed out; a number found taken means the
+    # mark is stale, and it is reseeded.
+    def __init__(self, path, seed, in_use=None):
+        self.path = path
+        self.seed = seed
+        self.in_use = in_use
+        self._next = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        with self._lock:
+            mtime = _mtime(self.path)
+            if self._next is None or mtime != self._mtime:
+                self._next = self.seed() + 1
+                self._mtime = mtime
+            n = self._next
+            if self.in_use and self.in_use(n):
+                n = max(self.seed() + 1, n + 1)
+                while self.in_use(n):
+                    n += 1
+            self._next = n + 1
+            return n
+
+    def reset(self):
+        with self._lock:
+            self._next = None
+
+
+def ldap_ids(ou, objclass, attr):
+    try:
+        qset = conns.LDAP.search_s("%s,%s" % (ou, config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org")),
+            ldap.SCOPE_SUBTREE, "(objectClass=%s)" % objclass, [attr])
+    except ldap.NO_SUCH_OBJECT:
+        return []
+    return [int(x[1][attr][0]) for x in qset if x[1].get(attr)]
+
+def ldap_in_use(ou, attr, n):
+    try:
+        qset = conns.LDAP.search_s("%s,%s" % (ou, config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org")),
+            ldap.SCOPE_SUBTREE, "(%s=%s)" % (attr, int(n)), ["1.1"])
+    except ldap.NO_SUCH_OBJECT:
+        return False
+    return len(qset) > 0
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
@@ -0,0 +1,195 @@
+import mmap
+import os
+import psutil
+import re
+import struct
+import threading
+import time
+
+from arkos import config
+from arkos.system import network
+
+# (resolution in seconds, number of slots): 1 day of 10s points,
+# 1 week of 1m points and 30 days of 1h points
+TIERS = [(10, 8640), (60, 10080), (3600, 720)]
+
+# Each slot holds bucket number, sum, count, min and max as doubles
+SLOT = struct.Struct("5d")
+
+# Interface types from network.get_interface_type() that get rx/tx series
+NET_TYPES = ["ethernet", "wireless", "ppp", "bridge"]
+
+
+class Series:
+    # One metric at one resolution, kept in a fixed-size ring file that is
+    # memory-mapped, so it never grows however long the host is up
+    def __init__(self, path, resolution, slots):
+        self.path = path
+        self.resolution = resolution
+        self.slots = slots
+        size = SLOT.size * slots
+        with open(path, "a+b") as f:
+            if os.path.getsize(path) != size:
+                f.truncate(size)
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def record(self, t, value):
+        bucket = int(t // self.resolution)
+        offset = (bucket % self.slots) * SLOT.size
+        b, total, count, low, high = SLOT.unpack_from(self._map, offset)
+        if b != bucket or not count:
+            SLOT.pack_into(self._map, offset, bucket, value, 1, value, value)
+        else:
+            SLOT.pack_into(self._map, offset, bucket, total + value, count + 1,
+                min(low, value), max(high, value))
+
+    def read(self, start, end):
+        # Returns [(time, avg, min, max), ...] for buckets still in the ring
+        points = []
+        first = max(int(start // self.resolution), int(end // self.resolution) - self.slots + 1)
+        for bucket in range(first, int(end // self.resolution) + 1):
+            b, total, count, low, high = SLOT.unpack_from(self._map,
+                (bucket % self.slots) * SLOT.size)
+            if b == bucket and count:
+                points.append((bucket * self.resolution, total / count, low, high))
+        return points
+
+    def span(self):
+        return self.resolution * self.slots
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class MetricsStore:
+    def __init__(self, path="/var/lib/arkos/metrics", tiers=TIERS):
+        self.path = path
+        self.tiers = tiers
+        self._series = {}
+        self._net = {}
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def record(self, name, value, t=None):
+        self.record_many({name: value}, t)
+
+    def record_many(self, values, t=None):
+        t = t or time.time()
+        with self._lock:
+            for name in values:
+                if values[name] is None:
+                    continue
+                for x in self._get_series(name):
+                    x.record(t, float(values[name]))
+
+    def record_stats(self, data, t=None):
+        # Flattens a stats.get_all() sample, plus per-interface rx/tx rates
+        # in bytes per second, into individual metrics
+        t = t or time.time()
+        values = {
+            "load.1": data["load"][0],
+            "load.5": data["load"][1],
+            "load.15": data["load"][2],
+            "cpu": data["cpu"],
+            "ram.used": data["ram"][0],
+            "ram.total": data["ram"][1],
+            "swap.used": data["swap"][0],
+            "swap.total": data["swap"][1]
+        }
+        temp = re.match("[-\d.]+", data.get("temp") or "")
+        if temp:
+            values["temp"] = float(temp.group(0))
+        # Interface counters are cumulative, so rates come from the change
+        # since the previous call; a counter that went backwards (a reboot
+        # or wrap) just restarts the baseline. Only physical links, PPP and
+        # bridges are kept, so short-lived veth, tun and container
+        # interfaces don't each add a set of rings
+        nics = dict([x for x in psutil.net_io_counters(pernic=True).items()
+            if network.get_interface_type(x[0]) in NET_TYPES])
+        for iface in [x for x in self._net if not x in nics]:
+            del self._net[iface]
+            self._drop_series("net.%s.rx" % iface)
+            self._drop_series("net.%s.tx" % iface)
+        for iface, counters in nics.items():
+            last = self._net.get(iface)
+            self._net[iface] = (t, counters.bytes_recv, counters.bytes_sent)
+            if not last or t <= last[0] or counters.bytes_recv < last[1] \
+                    or counters.bytes_sent < last[2]:
+                continue
+            values["net.%s.rx" % iface] = (counters.bytes_recv - last[1]) / (t - last[0])
+            values["net.%s.tx" % iface] = (counters.bytes_sent - last[2]) / (t - last[0])
+        self.record_many(values, t)
+
+    def query(self, name, start, end=None, resolution=None):
+        # Returns [(time, avg, min, max), ...] from the finest tier that
+        # still covers start, or from the tier with the given resolution
+        end = end or time.time()
+        with self._lock:
+            series = self._get_series(name)
+            if resolution:
+                series = [x for x in series if x.resolution == resolution]
+            else:
+                now = time.time()
+                series = [x for x in series if now - start <= x.span()] or series[-1:]
+            return series[0].read(start, end) if series else []
+
+    def aggregate(self, name, start, end=None, fn="avg"):
+        points = self.query(name, start, end)
+        if not points:
+            return None
+        if fn == "min":
+            return min(x[2] for x in points)
+        elif fn == "max":
+            return max(x[3] for x in points)
+        elif fn == "last":
+            return points[-1][1]
+        return sum(x[1] for x in points) / len(points)
+
+    def names(self):
+        return sorted(set(x.rsplit(".", 2)[0] for x in os.listdir(self.path)
+            if x.endswith(".ring")))
+
+    def flush(self):
+        with self._lock:
+            for x in self._series.values():
+                for y in x:
+                    y.flush()
+
+    def close(self):
+        with self._lock:
+            for x in self._series.values():
+                for y in x:
+                    y.close()
+            self._series = {}
+
+    def _drop_series(self, name):
+        # Closes the rings of a metric that is no longer recorded; the files
+        # stay, so its history can still be queried
+        with self._lock:
+            for x in self._series.pop(name, []):
+                x.close()
+
+    def _get_series(self, name):
+        if not name in self._series:
+            fname = re.sub("[^A-Za-z0-9_.-]", "_", name)
+            self._series[name] = [Series(os.path.join(self.path, "%s.%s.ring" % (fname, x[0])),
+                x[0], x[1]) for x in self.tiers]
+        return self._series[name]
+
+
+def get_store():
+    global store
+    with _store_lock:
+        if not store:
+            store = MetricsStore(config.get("stats", "metrics_dir", "/var/lib/arkos/metrics"))
+        return store
+
+
+store = None
+_store_lock = threading.Lock()
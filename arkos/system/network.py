@@ -133,21 +133,7 @@ def get_connections(name=None):
 def get_interfaces(name=None):
     ifaces = []
     for x in netifaces.interfaces():
-        if x[:-1] in ['ppp', 'wvdial']:
-            itype = 'ppp'
-        elif x[:2] in ['wl', 'ra', 'wi', 'at']:
-            itype = 'wireless'
-        elif x[:2].lower() == 'br':
-            itype = 'bridge'
-        elif x[:2].lower() == 'tu':
-            itype = 'tunnel'
-        elif x.lower() == 'lo':
-            itype = 'loopback'
-        elif x[:2] in ["et", "en"]:
-            itype = 'ethernet'
-        else:
-            itype = "unknown"
-        i = Interface(name=x, itype=itype)
+        i = Interface(name=x, itype=get_interface_type(x))
         data = psutil.net_io_counters(pernic=True)
         data = data[x] if type(data) == dict else data
         i.rx, i.tx = data[0], data[1]
@@ -162,6 +148,21 @@ def get_interfaces(name=None):
         ifaces.append(i)
     return ifaces if not name else None
 
+def get_interface_type(name):
+    if name[:-1] in ['ppp', 'wvdial']:
+        return 'ppp'
+    elif name[:2] in ['wl', 'ra', 'wi', 'at']:
+        return 'wireless'
+    elif name[:2].lower() == 'br':
+        return 'bridge'
+    elif name[:2].lower() == 'tu':
+        return 'tunnel'
+    elif name.lower() == 'lo':
+        return 'loopback'
+    elif name[:2] in ["et", "en"]:
+        return 'ethernet'
+    return "unknown"
+
 def get_active_ranges():
     ranges = []
     for x in get_interfaces():
@@ -1,6 +1,102 @@
+import os
+import re
+import threading
+
 from arkos.utilities import shell
 
 
+class PackageIndex:
+    # In-memory set of installed package names, read from disk on first
+    # use and again whenever the mtime of one of the watched directories
+    # changes, so installation checks are set lookups rather than forks
+    def __init__(self, paths, reader, normalize=None):
+        self.paths = paths
+        self.reader = reader
+        self.normalize = normalize
+        self._names = set()
+        self._sig = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return (self.normalize(name) if self.normalize else name) in self.get()
+
+    def get(self):
+        sig = self._signature()
+        with self._lock:
+            if sig != self._sig:
+                self._names = set(self.reader(self.paths))
+                self._sig = sig
+            return self._names
+
+    def _signature(self):
+        sig = []
+        for x in self.paths:
+            try:
+                sig.append(os.stat(x).st_mtime)
+            except OSError:
+                sig.append(None)
+        return sig
+
+
+class Transaction:
+    # Collects packages to install or remove so that a whole app stack
+    # costs one database sync and one pacman run. commit() returns the
+    # status of each package: "installed", "already installed", "removed",
+    # "not installed", "not found", "required" (by another package) or
+    # "failed". Packages pacman rejects by name are dropped and the rest
+    # retried once, so one bad package does not fail the others.
+    def __init__(self, install=[], remove=[]):
+        self.install = []
+        self.remove = []
+        for x in install:
+            self.add(x)
+        for x in remove:
+            self.drop(x)
+
+    def add(self, package):
+        if not package in self.install:
+            self.install.append(package)
+
+    def drop(self, package):
+        if not package in self.remove:
+            self.remove.append(package)
+
+    def commit(self, sync=True, purge=False):
+        status = {}
+        if self.remove:
+            pkgs = [x for x in self.remove if x in index]
+            status.update(dict([(x, "not installed") for x in self.remove if not x in pkgs]))
+            status.update(self._run("pacman --noconfirm -R%s" % ("n" if purge else ""),
+                pkgs, "removed", ":: removing (\S+) breaks dependency", "required"))
+        if self.install:
+            pkgs = [x for x in self.install if not x in index]
+            status.update(dict([(x, "already installed") for x in self.install if not x in pkgs]))
+            if pkgs and sync:
+                s = shell("pacman -Sy")
+                if s["code"] != 0:
+                    raise Exception("Failed to sync package databases: %s" % str(s["stderr"]))
+            status.update(self._run("pacman --noconfirm -S --needed", pkgs,
+                "installed", "target not found: (\S+)", "not found"))
+        return status
+
+    def _run(self, cmd, pkgs, done, reject, rejected):
+        status = {}
+        for attempt in range(2):
+            if not pkgs:
+                break
+            s = shell("%s %s" % (cmd, " ".join(pkgs)))
+            if s["code"] == 0:
+                status.update(dict([(x, done) for x in pkgs]))
+                return status
+            bad = set(re.findall(reject, s["stdout"] + s["stderr"])) & set(pkgs)
+            status.update(dict([(x, rejected) for x in bad]))
+            pkgs = [x for x in pkgs if not x in bad]
+            if not bad:
+                break
+        status.update(dict([(x, "failed") for x in pkgs]))
+        return status
+
+
 def install(packages, query=False, needed=True):
     s = shell("pacman --noconfirm -S%s %s%s" % (("y" if query else ""),("--needed " if needed else "")," ".join(packages)))
     if s["code"] != 0:
@@ -12,6 +108,15 @@ def remove(packages, purge=False):
         raise Exception("Failed to remove %s: %s" % (" ".join(packages), str(s["stderr"])))
 
 def is_installed(package):
-    s = shell("pacman -Q %s" % package)
-    if s["code"] != 0:
-        raise Exception("Failed to query %s: %s" % (package, str(s["stderr"])))
+    return package in index
+
+def _read_local(paths):
+    # Entries in the local database are named <pkgname>-<pkgver>-<pkgrel>
+    for path in paths:
+        if os.path.isdir(path):
+            for x in os.listdir(path):
+                if x.count("-") >= 2:
+                    yield x.rsplit("-", 2)[0]
+
+
+index = PackageIndex(["/var/lib/pacman/local"], _read_local)
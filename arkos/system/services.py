@@ -1,8 +1,15 @@
 import ConfigParser
 import glob
+import json
 import os
+import re
+import subprocess
+import threading
+import time
+import xmlrpclib
 
 from arkos import conns
+from arkos.connections import systemd_unit_properties
 from arkos.utilities import shell
 
 
@@ -40,8 +47,9 @@ class Service:
     
     def restart(self):
         if self.stype == 'supervisor':
-            conns.Supervisor.stopProcess(self.name, wait=True)
-            conns.Supervisor.startProcess(self.name)
+            error = supervisor_action("restart", [self.name])[self.name]
+            if error:
+                raise Exception('Failed to restart %s: %s' % (self.name, error))
         else:
             conns.SystemD.ReloadOrRestartUnit(self.name+".service", "replace")
 
@@ -58,6 +66,15 @@ class Service:
             s = shell("systemctl --no-ask-password status {}.service".format(self.name))["stdout"]
         return s
 
+    def stream_log(self, cursor=None, follow=False, lines=50, interval=1):
+        # Yields {"cursor", "time", "message"} entries, oldest first. Pass the
+        # last cursor seen to resume without rereading; with follow, keeps
+        # yielding new entries until the generator is closed. Supervisor
+        # entries with "skipped" count log bytes lost between reads
+        if self.stype == 'supervisor':
+            return _stream_supervisor_log(self.name, cursor, follow, lines, interval)
+        return _stream_journal(self.name+".service", cursor, follow, lines)
+
     def enable(self):
         if self.stype == 'supervisor':
             svd = get("supervisord")
@@ -105,35 +122,367 @@ class Service:
         }
 
 
-def get(name=None):
-    svcs = []
+class ServiceStateCache:
+    # Keeps Service objects current from systemd's unit signals, so
+    # listings are served from memory. Supervisor has no signal interface
+    # over XML-RPC, so its programs are refreshed on a timer instead.
+    def __init__(self, supervisor_interval=10):
+        self.supervisor_interval = supervisor_interval
+        self.running = False
+        self._systemd = {}
+        self._supervisor = {}
+        self._lock = threading.Lock()
 
-    for unit in conns.SystemD.ListUnits():
-        if not unit[0].endswith(".service"):
-            continue
-        try:
-            enabled = conns.SystemD.GetUnitFileState(unit[0])=="enabled"
-        except:
-            enabled = False
-        s = Service(name=unit[0].split(".service")[0], stype="system",
-            state="running" if unit[3]=="active" else "stopped",
-            enabled=enabled)
-        if name == s.name:
+    def start(self):
+        if self.running:
+            return
+        bus, self._manager, mainloop = _signal_bus()
+        bus.add_signal_receiver(self._on_unit_new, "UnitNew",
+            "org.freedesktop.systemd1.Manager")
+        bus.add_signal_receiver(self._on_unit_removed, "UnitRemoved",
+            "org.freedesktop.systemd1.Manager")
+        bus.add_signal_receiver(self._on_unit_files_changed, "UnitFilesChanged",
+            "org.freedesktop.systemd1.Manager")
+        bus.add_signal_receiver(self._on_properties_changed, "PropertiesChanged",
+            "org.freedesktop.DBus.Properties", "org.freedesktop.systemd1",
+            path_keyword="path")
+        self.refresh()
+        self.running = True
+        loop = mainloop.MainLoop()
+        t = threading.Thread(target=loop.run, name="ServiceStateCache")
+        t.daemon = True
+        t.start()
+        t = threading.Thread(target=self._poll_supervisor, name="ServiceStateCache-supervisor")
+        t.daemon = True
+        t.start()
+
+    def refresh(self):
+        systemd = dict([(x.name, x) for x in get_systemd()])
+        supervisor = dict([(x.name, x) for x in get_supervisor()])
+        with self._lock:
+            self._systemd, self._supervisor = systemd, supervisor
+
+    def get(self, name=None):
+        with self._lock:
+            if name:
+                return self._systemd.get(name) or self._supervisor.get(name)
+            return sorted(self._systemd.values() + self._supervisor.values(),
+                key=lambda s: s.name)
+
+    def _on_unit_new(self, unit, path):
+        if not unit.endswith(".service") or unit.endswith("@.service"):
+            return
+        name = str(unit).split(".service")[0]
+        with self._lock:
+            if not name in self._systemd:
+                self._systemd[name] = Service(name=name, stype="system",
+                    state="stopped", enabled=False)
+
+    def _on_unit_removed(self, unit, path):
+        name = str(unit).split(".service")[0]
+        with self._lock:
+            if unit.endswith(".service") and name in self._systemd:
+                self._systemd[name].state = "stopped"
+
+    def _on_unit_files_changed(self):
+        states = {}
+        for unit in self._manager.ListUnitFiles():
+            uname = os.path.basename(unit[0])
+            if uname.endswith(".service"):
+                states[uname.split(".service")[0]] = str(unit[1])
+        with self._lock:
+            for x in self._systemd.values():
+                x.enabled = states.get(x.name) == "enabled"
+
+    def _on_properties_changed(self, interface, changed, invalidated, path=""):
+        if interface != "org.freedesktop.systemd1.Unit" or not "ActiveState" in changed:
+            return
+        unit = _unit_from_path(path)
+        if not unit.endswith(".service"):
+            return
+        name = unit.split(".service")[0]
+        state = "running" if changed["ActiveState"]=="active" else "stopped"
+        with self._lock:
+            if name in self._systemd:
+                self._systemd[name].state = state
+            else:
+                self._systemd[name] = Service(name=name, stype="system",
+                    state=state, enabled=False)
+
+    def _poll_supervisor(self):
+        while self.running:
+            time.sleep(self.supervisor_interval)
+            try:
+                supervisor = get_supervisor()
+            except Exception:
+                continue
+            with self._lock:
+                for x in supervisor:
+                    if x.name in self._supervisor:
+                        self._supervisor[x.name].__dict__.update(x.__dict__)
+                    else:
+                        self._supervisor[x.name] = x
+                for x in set(self._supervisor) - set(y.name for y in supervisor):
+                    del self._supervisor[x]
+
+
+def get(name=None):
+    if cache.running:
+        return cache.get(name)
+    if name:
+        s = get_systemd(name)
+        if s:
             return s
-        svcs.append(s)
+        for s in get_supervisor():
+            if s.name == name:
+                return s
+        return None
+    return sorted(get_systemd() + get_supervisor(), key=lambda s: s.name)
 
+def get_supervisor():
+    svcs = []
     if not os.path.exists('/etc/supervisor.d'):
         os.mkdir('/etc/supervisor.d')
-    for x in os.listdir('/etc/supervisor.d'):
+    files = os.listdir('/etc/supervisor.d')
+    states = {}
+    if files:
+        for x in conns.Supervisor.getAllProcessInfo():
+            states[x["name"]] = x["statename"].lower()
+    for x in files:
         c = ConfigParser.RawConfigParser()
-        c.load(os.path.join("/etc/supervisor.d", x))
+        c.read(os.path.join("/etc/supervisor.d", x))
         cfg = {}
-        for x in c.items(c.sections()[0]):
-            cfg[x[0]] = x[1]
-        s = Service(name=x.split(".ini")[0], stype="supervisor",
-            state=conns.Supervisor.getProcessInfo(s.name)["statename"].lower(),
+        for y in c.items(c.sections()[0]):
+            cfg[y[0]] = y[1]
+        name = x.split(".ini")[0]
+        s = Service(name=name, stype="supervisor",
+            state=states.get(name, "stopped"),
             enabled=not x.endswith("disabled"), cfg=cfg)
-        if name == s.name:
-            return s
         svcs.append(s)
-    return sorted(svcs, key=lambda s: s.name) if not name else None
+    return svcs
+
+def get_systemd(name=None):
+    # A full listing is two bus calls: unit file states joined with the
+    # loaded units' active states. A single service is read from its unit
+    if name:
+        try:
+            path = conns.SystemD.LoadUnit(name+".service")
+            props = systemd_unit_properties(path).GetAll("org.freedesktop.systemd1.Unit")
+        except:
+            return None
+        if props["LoadState"] == "not-found":
+            return None
+        return Service(name=name, stype="system",
+            state="running" if props["ActiveState"]=="active" else "stopped",
+            enabled=props["UnitFileState"]=="enabled")
+
+    states, active = {}, {}
+    for unit in conns.SystemD.ListUnitFiles():
+        uname = os.path.basename(unit[0])
+        if uname.endswith(".service") and not uname.endswith("@.service"):
+            states[uname] = str(unit[1])
+    for unit in conns.SystemD.ListUnits():
+        if unit[0].endswith(".service"):
+            active[str(unit[0])] = str(unit[3])
+    svcs = []
+    for unit in set(states) | set(active):
+        svcs.append(Service(name=unit.split(".service")[0], stype="system",
+            state="running" if active.get(unit)=="active" else "stopped",
+            enabled=states.get(unit)=="enabled"))
+    return svcs
+
+def bulk(action, names, max_parallel=4, timeout=300):
+    # Runs start, stop, restart or real_restart on many services at once.
+    # systemd jobs are submitted concurrently, up to max_parallel in flight,
+    # in the order the units' After= dependencies imply (reversed for stop),
+    # and their completion is tracked through JobRemoved signals. Supervisor
+    # programs are handled in one multicall afterwards.
+    # Returns {name: systemd job result ("done", "failed", ...) or error}
+    system, supervisor = [], []
+    for x in names:
+        if os.path.exists(os.path.join('/etc/supervisor.d', x+'.ini')):
+            supervisor.append(x)
+        else:
+            system.append(x)
+    results = {}
+    if system:
+        results.update(_bulk_systemd(action, system, max_parallel, timeout))
+    if supervisor:
+        sr = supervisor_action("restart" if action == "real_restart" else action, supervisor)
+        for x in sr:
+            results[x] = sr[x] or "done"
+    return results
+
+def _bulk_systemd(action, names, max_parallel, timeout):
+    method = {"start": "StartUnit", "stop": "StopUnit",
+        "restart": "ReloadOrRestartUnit", "real_restart": "RestartUnit"}[action]
+    bus, manager, mainloop = _signal_bus()
+    done, jobs, results = {}, {}, {}
+    cond = threading.Condition()
+    def on_job_removed(id, job, unit, result):
+        with cond:
+            done[str(job)] = str(result)
+            cond.notify_all()
+    bus.add_signal_receiver(on_job_removed, "JobRemoved",
+        "org.freedesktop.systemd1.Manager")
+    loop = mainloop.MainLoop()
+    t = threading.Thread(target=loop.run)
+    t.daemon = True
+    t.start()
+    try:
+        units = _order_units(bus, manager, [x+".service" for x in names])
+        if action == "stop":
+            units.reverse()
+        deadline = time.time() + timeout
+        for unit in units:
+            with cond:
+                while len([x for x in jobs.values() if not x in done]) >= max_parallel \
+                        and time.time() < deadline:
+                    cond.wait(deadline - time.time())
+            if time.time() >= deadline:
+                results[unit] = "timeout"
+                continue
+            try:
+                jobs[unit] = str(getattr(manager, method)(unit, "replace"))
+            except Exception, e:
+                results[unit] = str(e)
+        with cond:
+            while [x for x in jobs.values() if not x in done] and time.time() < deadline:
+                cond.wait(deadline - time.time())
+            for unit in jobs:
+                results[unit] = done.get(jobs[unit], "timeout")
+    finally:
+        loop.quit()
+        bus.close()
+    return dict([(x.split(".service")[0], results[x]) for x in results])
+
+def _stream_journal(unit, cursor, follow, lines):
+    cmd = ["journalctl", "--no-pager", "-o", "json", "-u", unit]
+    cmd += ["--after-cursor", cursor] if cursor else ["-n", str(lines)]
+    if follow:
+        cmd.append("--follow")
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        env={"LC_ALL": "C"})
+    try:
+        for line in iter(p.stdout.readline, ""):
+            try:
+                e = json.loads(line)
+            except ValueError:
+                continue
+            msg = e.get("MESSAGE", "")
+            if type(msg) == list:
+                msg = "".join(chr(x) for x in msg)
+            yield {"cursor": e["__CURSOR"],
+                "time": int(e.get("__REALTIME_TIMESTAMP", 0)) / 1000000.0,
+                "message": msg}
+    finally:
+        if p.poll() is None:
+            p.terminate()
+        p.wait()
+
+def _stream_supervisor_log(name, cursor, follow, lines, interval):
+    # The cursor is a byte offset into the program's stdout log. Without
+    # one, start from roughly the last `lines` lines
+    if cursor is None:
+        data, offset, overflow = conns.Supervisor.tailProcessStdoutLog(name, 0, lines*200)
+        data = _log_bytes(data)
+        data = "\n".join(data.split("\n")[-lines-1:])
+        pos = offset - len(data)
+    else:
+        pos = int(cursor)
+        data, offset, overflow = conns.Supervisor.tailProcessStdoutLog(name, pos, 65536)
+        data = _log_bytes(data)
+    while True:
+        # Supervisor returns the last bytes up to EOF, not bytes from the
+        # cursor: anything before the cursor was already read, and a gap
+        # after it (more than 65536 new bytes) is reported as skipped
+        start = offset - len(data)
+        if start < pos:
+            data = data[pos-start:]
+        elif start > pos:
+            yield {"cursor": start, "time": time.time(), "message": "",
+                "skipped": start - pos}
+        # A trailing partial line is left unconsumed and reread next time
+        pos = offset - len(data)
+        parts = data.split("\n")
+        parts.pop()
+        for x in parts:
+            pos += len(x) + 1
+            yield {"cursor": pos, "time": time.time(),
+                "message": x.decode("utf-8", "replace")}
+        if not follow:
+            return
+        time.sleep(interval)
+        data, offset, overflow = conns.Supervisor.tailProcessStdoutLog(name, pos, 65536)
+        data = _log_bytes(data)
+
+def _log_bytes(data):
+    # xmlrpclib returns unicode for non-ASCII output; offsets count bytes
+    return data.encode("utf-8") if isinstance(data, unicode) else data
+
+def _order_units(bus, manager, units):
+    # Topological order over the units' After= lists, restricted to the
+    # units requested; anything left in a cycle keeps its given order
+    from dbus import Interface
+    after = {}
+    for unit in units:
+        try:
+            path = manager.LoadUnit(unit)
+            props = Interface(bus.get_object("org.freedesktop.systemd1", path),
+                dbus_interface="org.freedesktop.DBus.Properties")
+            after[unit] = set(str(x) for x in props.Get("org.freedesktop.systemd1.Unit", "After"))
+        except Exception:
+            after[unit] = set()
+    ordered, left = [], list(units)
+    while left:
+        ready = [x for x in left if not after[x] & set(left)]
+        if not ready:
+            ordered += left
+            break
+        ordered += ready
+        left = [x for x in left if not x in ready]
+    return ordered
+
+def _signal_bus():
+    # A private bus connection attached to a GLib main loop, for receiving
+    # systemd signals; the caller runs the loop
+    import dbus.mainloop.glib
+    from dbus import SystemBus, Interface
+    try:
+        from gi.repository import GLib as mainloop
+    except ImportError:
+        import gobject as mainloop
+        mainloop.threads_init()
+    dbus.mainloop.glib.threads_init()
+    bus = SystemBus(mainloop=dbus.mainloop.glib.DBusGMainLoop(), private=True)
+    manager = Interface(bus.get_object("org.freedesktop.systemd1",
+        "/org/freedesktop/systemd1"), dbus_interface="org.freedesktop.systemd1.Manager")
+    manager.Subscribe()
+    return bus, manager, mainloop
+
+def supervisor_action(action, names):
+    # Starts, stops or restarts several Supervisor programs in a single
+    # system.multicall; supervisord runs the calls in order, so for a
+    # restart every stop completes before the starts begin.
+    # Returns {name: error message or ""}
+    results = dict([(x, "") for x in names])
+    methods = {"start": ["startProcess"], "stop": ["stopProcess"],
+        "restart": ["stopProcess", "startProcess"]}[action]
+    calls = [(m, (x, True)) for m in methods for x in names]
+    for call, r in zip(calls, conns.Supervisor.multicall(calls)):
+        if isinstance(r, xmlrpclib.Fault) and not _ignorable_fault(call[0], r):
+            results[call[1][0]] = r.faultString
+    return results
+
+def _ignorable_fault(method, fault):
+    # Stopping a stopped program or starting a started one is not an error here
+    return (method == "stopProcess" and "NOT_RUNNING" in fault.faultString) \
+        or (method == "startProcess" and "ALREADY_STARTED" in fault.faultString)
+
+def _unit_from_path(path):
+    # systemd escapes unit names in object paths: nginx.service -> nginx_2eservice
+    name = str(path).rsplit("/", 1)[-1]
+    return re.sub("_([0-9a-f]{2})", lambda m: chr(int(m.group(1), 16)), name)
+
+
+cache = ServiceStateCache()
@@ -1,17 +1,93 @@
 #coding: utf-8
+import collections
 import os
 import psutil
+import threading
 import time
 
 from arkos import config
+from arkos.system import metrics
+
+
+class StatsCollector:
+    # Samples all stats on a background thread into a fixed-size ring, so
+    # readers get the latest values instantly and short history windows
+    # for graphs. Memory is bounded by size, however long it runs. If a
+    # metrics.MetricsStore is set as store, or persist is set, samples are
+    # also persisted.
+    def __init__(self, interval=5, size=360, persist=False):
+        self.interval = interval
+        self.size = size
+        self.persist = persist
+        self.running = False
+        self.store = None
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        if self.persist and not self.store:
+            self.store = metrics.get_store()
+        # Each run gets its own event, so a thread still finishing a sample
+        # after stop() can never be revived by the next start()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,),
+            name="StatsCollector")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self.running = False
+
+    def latest(self):
+        with self._lock:
+            return dict(self._samples[-1][1]) if self._samples else None
+
+    def history(self, seconds=None):
+        # Returns [{"time": ..., <stats>}, ...], oldest first
+        since = time.time() - seconds if seconds else 0
+        with self._lock:
+            samples = [x for x in self._samples if x[0] >= since]
+        return [dict(x[1], time=x[0]) for x in samples]
+
+    def _run(self, stop):
+        # CPU usage is measured over the interval between samples, so the
+        # first call only primes psutil's counters
+        get_cpu(None)
+        while not stop.is_set():
+            data, t = sample(None), time.time()
+            with self._lock:
+                self._samples.append((t, data))
+            if self.store:
+                self.store.record_stats(data, t)
+            stop.wait(self.interval)
 
 
 def get_all():
+    # Without a running collector this blocks for a second to measure CPU
+    if collector.running:
+        data = collector.latest()
+        if data:
+            return data
+    return sample()
+
+def get_history(seconds=None):
+    return collector.history(seconds)
+
+def sample(cpu_interval=1):
     return {
         "load": get_load(),
         "temp": get_temp(),
         "ram": get_ram(),
-        "cpu": get_cpu(),
+        "cpu": get_cpu(cpu_interval),
         "swap": get_swap(),
         "uptime": get_uptime()
     }
@@ -22,10 +98,12 @@ def get_load():
 def get_temp():
     # TODO: replace this with libsensors.so / PySensors
     if config.get("enviro", "board") == 'Raspberry Pi':
-        return '%3.1f°C'%(float(shell('cat /sys/class/thermal/thermal_zone0/temp').split('\n')[0])/1000)
+        path = '/sys/class/thermal/thermal_zone0/temp'
     else:
-        if os.path.exists('/sys/class/hwmon/hwmon1/temp1_input'):
-            return '%3.1f°C'%(float(shell('cat /sys/class/hwmon/hwmon1/temp1_input'))/1000)
+        path = '/sys/class/hwmon/hwmon1/temp1_input'
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return '%3.1f°C'%(float(f.readline())/1000)
     return ''
 
 def get_ram():
@@ -33,8 +111,10 @@ def get_ram():
     a = int(s.used) - (int(s.cached) + int(s.buffers))
     return (a, int(s.total), int(s.percent))
 
-def get_cpu():
-    return psutil.cpu_percent(interval=1)
+def get_cpu(interval=1):
+    # With interval=None this does not block and returns usage since the
+    # previous such call, which only the collector makes
+    return psutil.cpu_percent(interval=interval)
 
 def get_swap():
     s = psutil.swap_memory()
@@ -63,3 +143,7 @@ def get_uptime():
         uptime = "1 day, "
 
     return uptime + "%d:%02d:%02d"%(h,m,s)
+
+
+collector = StatsCollector(int(config.get("stats", "interval", 5)),
+    int(config.get("stats", "history", 360)), config.get("stats", "persist", False))
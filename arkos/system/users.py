@@ -1,15 +1,17 @@
 import grp
+import inspect
 import json
-import ldap, ldap.modlist
+import ldap, ldap.dn, ldap.filter, ldap.modlist
 import os
 import pwd
 import shutil
 import sys
 
 import groups
+import ids
 
 from arkos import conns, config
-from arkos.utilities import hashpw
+from arkos.utilities import hashpw_batch
 
 
 class User:
@@ -33,6 +35,11 @@ class User:
         except ldap.NO_SUCH_OBJECT:
             pass
 
+        conns.LDAP.add_s("uid=%s,ou=users,%s" % (self.name,self.rootdn),
+            self.get_ldif(_hashpw(passwd)))
+        self.update_adminsudo()
+
+    def get_ldif(self, passwd_hash):
         ldif = {
             "objectClass": ["mailAccount", "inetOrgPerson", "posixAccount"],
             "givenName": self.first_name,
@@ -42,15 +49,24 @@ class User:
             "uid": self.name,
             "mail": self.name+"@"+self.domain,
             "maildrop": self.name,
-            "userPassword": hashpw(passwd, "crypt"),
+            "userPassword": passwd_hash,
             "gidNumber": str(self.uid),
             "uidNumber": str(self.uid),
             "homeDirectory": "/home/%s" % self.name,
             "loginShell": "/usr/bin/bash"
             }
-        ldif = ldap.modlist.addModlist(ldif)
-        conns.LDAP.add_s("uid=%s,ou=users,%s" % (self.name,self.rootdn), ldif)
-        self.update_adminsudo()
+        return ldap.modlist.addModlist(ldif)
+
+    def get_sudo_ldif(self):
+        nldif = {
+            "objectClass": ["sudoRole", "top"],
+            "cn": self.name,
+            "sudoHost": "ALL",
+            "sudoCommand": "ALL",
+            "sudoUser": self.name,
+            "sudoOption": "authenticate"
+        }
+        return ldap.modlist.addModlist(nldif)
     
     def update(self, newpasswd=""):
         try:
@@ -71,7 +87,7 @@ class User:
             "mail": self.name+"@"+self.domain
         }
         if newpasswd:
-            attrs["userPassword"] = hashpw(newpasswd, "crypt")
+            attrs["userPassword"] = _hashpw(newpasswd)
         nldif = ldap.modlist.modifyModlist(ldif, attrs, ignore_oldexistent=1)
         conns.LDAP.modify_ext_s("uid=%s,ou=users,%s" % (self.name,self.rootdn), nldif)
         self.update_adminsudo()
@@ -98,16 +114,8 @@ class User:
             is_sudo = False
 
         if self.sudo and not is_sudo:
-            nldif = {
-                "objectClass": ["sudoRole", "top"],
-                "cn": self.name,
-                "sudoHost": "ALL",
-                "sudoCommand": "ALL",
-                "sudoUser": self.name,
-                "sudoOption": "authenticate"
-            }
-            nldif = ldap.modlist.addModlist(nldif)
-            conns.LDAP.add_s("cn=%s,ou=sudo,%s" % (self.name, self.rootdn), nldif)
+            conns.LDAP.add_s("cn=%s,ou=sudo,%s" % (self.name, self.rootdn),
+                self.get_sudo_ldif())
         elif not self.sudo and is_sudo:
             conns.LDAP.delete_s("cn=%s,ou=sudo,%s" % (self.name, self.rootdn))
     
@@ -174,34 +182,178 @@ class SystemUser:
 
 
 def get(uid=None):
-    r = []
-    for x in conns.LDAP.search_s("ou=users,%s" % config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org"), 
-            ldap.SCOPE_SUBTREE, "(objectClass=inetOrgPerson)", None):
-        for y in x[1]:
-            if type(x[1][y]) == list and len(x[1][y]) == 1:
-                x[1][y] = x[1][y][0]
-        u = User(name=x[1]["uid"], uid=int(x[1]["uidNumber"]), 
-            first_name=x[1]["givenName"], last_name=x[1]["sn"],
-            domain=x[1]["mail"].split("@")[1], rootdn=x[0].split("ou=users,")[1])
+    # One search each for users, sudo roles and admins, joined in memory
+    rootdn = config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org")
+    ufilter = "(objectClass=inetOrgPerson)"
+    if uid:
+        ufilter = "(&%s(uidNumber=%s))" % (ufilter, ldap.filter.escape_filter_chars(str(uid)))
+    qset = conns.LDAP.search_s("ou=users,%s" % rootdn, ldap.SCOPE_SUBTREE, ufilter, None)
+    if not qset:
+        return [] if not uid else None
+    sfilter = "(objectClass=sudoRole)"
+    if uid:
+        sfilter = "(&%s(cn=%s))" % (sfilter, ldap.filter.escape_filter_chars(qset[0][1]["uid"][0]))
+    sudoers, admins = get_sudoers(rootdn, sfilter), get_admins(rootdn)
+    r = [_from_ldif(x, sudoers, admins) for x in qset]
+    return r if not uid else r[0]
 
-        try:
-            conns.LDAP.search_s("cn=%s,ou=sudo,%s" % (u.name,u.rootdn),
-                ldap.SCOPE_SUBTREE, "(objectClass=*)", None)
-            u.sudo = True
-        except ldap.NO_SUCH_OBJECT:
-            u.sudo = False
+def bulk_add(specs):
+    # Provisions many users at once. Each spec is a dict of User arguments
+    # plus "passwd". Names are checked in one search, entries and sudo roles
+    # are sent with asynchronous adds on one connection, and admins are
+    # added to the admins group in a single modify. Returns one
+    # {"name", "user", "error"} dict per spec, in order.
+    rootdn = config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org")
+    allowed = set(inspect.getargspec(User.__init__).args[1:] + ["passwd"])
+    results = []
+    for x in specs:
+        r = {"name": str(x.get("name") or ""), "user": None, "error": ""}
+        unknown = sorted(set(x) - allowed)
+        if not r["name"]:
+            r["error"] = "A name is required"
+        elif not x.get("passwd"):
+            r["error"] = "A password is required"
+        elif unknown:
+            r["error"] = "Unknown field(s): %s" % ", ".join(unknown)
+        results.append(r)
+    names = [x["name"] for x in results if not x["error"]]
+    if not names:
+        return results
+    existing = set()
+    for chunk in [names[i:i+500] for i in range(0, len(names), 500)]:
+        qset = conns.LDAP.search_s("ou=users,%s" % rootdn, ldap.SCOPE_SUBTREE,
+            "(|%s)" % "".join("(uid=%s)" % ldap.filter.escape_filter_chars(x) for x in chunk),
+            ["uid"])
+        existing.update(y for x in qset for y in x[1].get("uid", []))
 
-        memlist = conns.LDAP.search_s("cn=admins,ou=groups,%s" % u.rootdn,
-            ldap.SCOPE_SUBTREE, "(objectClass=*)", None)[0][1]["member"]
-        if "uid=%s,ou=users,%s"%(u.name,u.rootdn) in memlist:
-            u.admin = True
+    pending, seen = [], set()
+    for r, spec in zip(results, specs):
+        if r["error"]:
+            continue
+        elif r["name"] in existing:
+            r["error"] = "A user with this name already exists"
+        elif r["name"] in seen:
+            r["error"] = "This name appears more than once in the batch"
         else:
-            u.admin = False
+            seen.add(r["name"])
+            args = dict([(x, spec[x]) for x in spec if x != "passwd"])
+            args["rootdn"] = rootdn
+            try:
+                r["user"] = User(**args)
+            except Exception, e:
+                r["error"] = str(e)
+                continue
+            pending.append((r, spec["passwd"]))
+    hashes = hashpw_batch([x[1] for x in pending], *_hash_scheme(), timeout=_hash_timeout())
+    pending = zip([x[0] for x in pending], hashes)
+
+    admins = []
+    with conns.LDAP.connection() as c:
+        msgids = []
+        # A failed submit (server gone, unencodable value) only fails that
+        # user; entries already sent are still collected below
+        for r, pwhash in pending:
+            u = r["user"]
+            try:
+                msgids.append((r, c.add_ext("uid=%s,ou=users,%s" % (u.name, u.rootdn),
+                    u.get_ldif(pwhash))))
+            except (ldap.LDAPError, UnicodeError), e:
+                r["error"], r["user"] = _ldap_error(e), None
+        sudo_msgids = []
+        for r, msgid in msgids:
+            try:
+                c.result3(msgid)
+            except ldap.LDAPError, e:
+                r["error"], r["user"] = _ldap_error(e), None
+                continue
+            u = r["user"]
+            if u.sudo:
+                try:
+                    sudo_msgids.append((r, c.add_ext("cn=%s,ou=sudo,%s" % (u.name, u.rootdn),
+                        u.get_sudo_ldif())))
+                except (ldap.LDAPError, UnicodeError), e:
+                    u.sudo = False
+                    r["error"] = "User added, but sudo role failed: %s" % _ldap_error(e)
+            if u.admin:
+                admins.append((r, "uid=%s,ou=users,%s" % (u.name, u.rootdn)))
+        for r, msgid in sudo_msgids:
+            try:
+                c.result3(msgid)
+            except ldap.LDAPError, e:
+                r["user"].sudo = False
+                r["error"] = "User added, but sudo role failed: %s" % _ldap_error(e)
+        if admins:
+            try:
+                c.modify_ext_s("cn=admins,ou=groups,%s" % rootdn,
+                    [(ldap.MOD_ADD, "member", [x[1] for x in admins])])
+            except ldap.LDAPError, e:
+                for r, dn in admins:
+                    r["user"].admin = False
+                    r["error"] = "; ".join(filter(None, [r["error"],
+                        "User added, but admin membership failed: %s" % _ldap_error(e)]))
+    return results
 
-        if u.uid == uid:
-            return u
-        r.append(u)
-    return r if not uid else None
+def _hash_scheme():
+    rounds = config.get("general", "password_rounds")
+    return (config.get("general", "password_scheme", "ldap_sha512_crypt"),
+        int(rounds) if rounds else None)
+
+def _hash_timeout():
+    return int(config.get("general", "password_timeout", 30))
+
+def _hashpw(passwd):
+    return hashpw_batch([passwd], *_hash_scheme(), timeout=_hash_timeout())[0]
+
+def _ldap_error(e):
+    if e.args and type(e.args[0]) == dict:
+        return e.args[0].get("desc", str(e))
+    return str(e)
+
+def get_by_name(name):
+    rootdn = config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org")
+    try:
+        qset = conns.LDAP.search_s("uid=%s,ou=users,%s" % (ldap.dn.escape_dn_chars(name), rootdn),
+            ldap.SCOPE_BASE, "(objectClass=inetOrgPerson)", None)
+    except ldap.NO_SUCH_OBJECT:
+        return None
+    if not qset:
+        return None
+    sfilter = "(&(objectClass=sudoRole)(cn=%s))" % ldap.filter.escape_filter_chars(name)
+    return _from_ldif(qset[0], get_sudoers(rootdn, sfilter), get_admins(rootdn))
+
+def iter_users(page_size=500):
+    rootdn = config.get("general", "ldap_rootdn", "dc=arkos-servers,dc=org")
+    sudoers, admins = get_sudoers(rootdn), get_admins(rootdn)
+    for x in conns.LDAP.paged_search("ou=users,%s" % rootdn, ldap.SCOPE_SUBTREE,
+            "(objectClass=inetOrgPerson)", None, page_size):
+        yield _from_ldif(x, sudoers, admins)
+
+def get_sudoers(rootdn, sfilter="(objectClass=sudoRole)"):
+    try:
+        qset = conns.LDAP.search_s("ou=sudo,%s" % rootdn, ldap.SCOPE_SUBTREE,
+            sfilter, ["cn"])
+    except ldap.NO_SUCH_OBJECT:
+        return set()
+    return set(y for x in qset for y in x[1].get("cn", []))
+
+def get_admins(rootdn):
+    try:
+        qset = conns.LDAP.search_s("cn=admins,ou=groups,%s" % rootdn,
+            ldap.SCOPE_BASE, "(objectClass=*)", ["member"])
+    except ldap.NO_SUCH_OBJECT:
+        return set()
+    return set(x.lower() for x in qset[0][1].get("member", []))
+
+def _from_ldif(x, sudoers, admins):
+    for y in x[1]:
+        if type(x[1][y]) == list and len(x[1][y]) == 1:
+            x[1][y] = x[1][y][0]
+    u = User(name=x[1]["uid"], uid=int(x[1]["uidNumber"]), 
+        first_name=x[1]["givenName"], last_name=x[1]["sn"],
+        domain=x[1]["mail"].split("@")[1], rootdn=x[0].split("ou=users,")[1])
+    u.sudo = u.name in sudoers
+    u.admin = ("uid=%s,ou=users,%s" % (u.name, u.rootdn)).lower() in admins
+    return u
 
 def get_system(uid=None):
     r = []
@@ -219,4 +371,19 @@ def get_system(uid=None):
     return sorted(r, key=lambda x: x.uid) if not uid else None
 
 def get_next_uid():
-    return max([x.uid for x in get_system()]) + 1
+    return uids.allocate()
+
+def _seed_uid():
+    found = [x.pw_uid for x in pwd.getpwall() if x.pw_name != "root"]
+    found += ids.ldap_ids("ou=users", "posixAccount", "uidNumber")
+    return max(found or [0])
+
+def _uid_in_use(uid):
+    try:
+        pwd.getpwuid(uid)
+        return True
+    except KeyError:
+        return ids.ldap_in_use("ou=users", "uidNumber", uid)
+
+
+uids = ids.IDAllocator("/etc/passwd", _seed_uid, _uid_in_use)
@@ -2,11 +2,15 @@ import json
 import os
 import random
 import sys
+import threading
 
 from arkos import config, storage, security
 
 COMMON_PORTS = [3000, 3306, 5222, 5223, 5232, 8000, 8080, 8765]
 
+policy_path = None
+_init_lock = threading.Lock()
+
 
 class SecurityPolicy:
     def __init__(self, type="", id="", name="", icon="", ports=[], policy=2):
@@ -18,14 +22,14 @@ class SecurityPolicy:
         self.policy = policy
 
     def save(self, fw=True):
-        with open(policy_path, "r") as f:
+        with open(get_policy_path(), "r") as f:
             policies = json.loads(f.read())
         if policies.has_key(self.type):
-            policies[self.type][self.id] = policy
+            policies[self.type][self.id] = self.policy
         else:
             policies[self.type] = {}
-            policies[self.type][self.id] = policy
-        with open(policy_path, "w") as f:
+            policies[self.type][self.id] = self.policy
+        with open(get_policy_path(), "w") as f:
             f.write(json.dumps(policies, sort_keys=True, 
                 indent=4, separators=(',', ': ')))
         if config.get("general", "firewall", True) and fw:
@@ -33,13 +37,13 @@ class SecurityPolicy:
         storage.policies.add("policies", self)
 
     def remove(self, fw=True):
-        with open(policy_path, "r") as f:
+        with open(get_policy_path(), "r") as f:
             policies = json.loads(f.read())
         if policies.has_key(self.type) and len(policies[self.type]) <= 1:
             del policies[self.type]
         elif policies.has_key(self.type) and policies[self.type].has_key(self.id):
             del policies[self.type][self.id]
-        with open(policy_path, "w") as f:
+        with open(get_policy_path(), "w") as f:
             f.write(json.dumps(policies, sort_keys=True, 
                 indent=4, separators=(',', ': ')))
         if config.get("general", "firewall", True) and fw:
@@ -58,19 +62,14 @@ class SecurityPolicy:
 
 
 def get(type=None):
-    data = storage.policies.get("policies")
+    if policy_path is None:
+        initialize()
     if type:
-        tlist = []
-        for x in data:
-            if x == type:
-                tlist.append(data[x])
-        if tlist:
-            return tlist
-        return None
-    return data
+        return storage.policies.get_by("policies", "type", type) or None
+    return storage.policies.get("policies")
 
 def register(type, id, name, icon, ports, policy=0, fw=True):
-    with open(policy_path, "r") as f:
+    with open(get_policy_path(), "r") as f:
         policies = json.loads(f.read())
     if not policy:
         if policies.has_key(type) and policies[type].has_key(id):
@@ -96,7 +95,7 @@ def deregister(type, id="", fw=True):
         security.regen_fw(get())
 
 def refresh_policies():
-    with open(policy_path, "r") as f:
+    with open(get_policy_path(), "r") as f:
         policies = json.loads(f.read())
     svcs = get()
     newpolicies = {}
@@ -110,7 +109,7 @@ def refresh_policies():
                 for s in policies[x]:
                     if s == y.id:
                         newpolicies[x][s] = policies[x][s]
-    with open(policy_path, "w") as f:
+    with open(get_policy_path(), "w") as f:
         f.write(json.dumps(newpolicies, sort_keys=True, 
             indent=4, separators=(',', ': ')))
 
@@ -122,18 +121,30 @@ def get_open_port(ignore_common=False):
     return r if not r in ports else get_open_port()
 
 
-if os.path.exists(os.path.join(sys.path[0], "policies.json")):
-    policy_path = os.path.join(sys.path[0], "policies.json")
-elif os.path.exists("/etc/arkos/policies.json"):
-    policy_path = "/etc/arkos/policies.json"
-with open(policy_path, "r") as f:
-    policies = json.loads(f.read())
-policy = policies["arkos"]["arkos"] if policies.has_key("arkos") \
-    and policies["arkos"].has_key("arkos") else 2
-storage.policies.add("policies", SecurityPolicy("arkos", "arkos", 
-    "System Management (Genesis/APIs)", "gen-arkos-round", 
-    [("tcp", int(config.get("genesis", "port"))), ("tcp", 8765)], policy))
-if policies.has_key("custom"):
-    for x in policies["custom"]:
-        storage.policies.add("policies", SecurityPolicy("custom", x["id"], 
-            x["name"], x["icon"], x["ports"], x["policy"]))
+def get_policy_path():
+    if policy_path is None:
+        initialize()
+    return policy_path
+
+def initialize():
+    # Policies are read on first use rather than when the module is imported
+    global policy_path
+    with _init_lock:
+        if policy_path is not None:
+            return
+        if os.path.exists(os.path.join(sys.path[0], "policies.json")):
+            path = os.path.join(sys.path[0], "policies.json")
+        else:
+            path = "/etc/arkos/policies.json"
+        with open(path, "r") as f:
+            policies = json.loads(f.read())
+        policy = policies["arkos"]["arkos"] if policies.has_key("arkos") \
+            and policies["arkos"].has_key("arkos") else 2
+        storage.policies.add("policies", SecurityPolicy("arkos", "arkos", 
+            "System Management (Genesis/APIs)", "gen-arkos-round", 
+            [("tcp", int(config.get("genesis", "port"))), ("tcp", 8765)], policy))
+        if policies.has_key("custom"):
+            for x in policies["custom"]:
+                storage.policies.add("policies", SecurityPolicy("custom", x["id"], 
+                    x["name"], x["icon"], x["ports"], x["policy"]))
+        policy_path = path
@@ -1,8 +1,9 @@
 import json
 import gnupg
+import shutil
 
-from arkos import storage, config, logger
-from arkos.utilities import api, DefaultMessage
+from arkos import storage, config, logger, artifacts
+from arkos.utilities import api, shell, DefaultMessage
 
 
 def check_updates():
@@ -46,7 +47,9 @@ def install_updates(message=DefaultMessage()):
                     break
             elif x[1]["unit"] == "fetch":
                 try:
-                    download(x[1]["order"], x[1]["data"], True)
+                    path = artifacts.get_cache().fetch(x[1]["order"], z[1]["id"],
+                        x[1].get("sha256"))
+                    shutil.copyfile(path, x[1]["data"])
                 except Exception, e:
                     code = 1
                     if hasattr(e, "code"):
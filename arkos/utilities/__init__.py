@@ -8,11 +8,15 @@ __all__ = [
     "cidr_to_netmask",
     "netmask_to_cidr",
     "download",
+    "JSONBase64Reader",
     "get_current_entropy",
     "random_string",
     "api",
     "shell",
     "hashpw",
+    "hashpw_async",
+    "hashpw_batch",
+    "get_hash_pool",
     "can_be_int",
     "str_fsize",
     "detect_architecture",
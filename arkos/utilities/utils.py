@@ -1,19 +1,24 @@
 import base64
 import crypt
-import git
 import hashlib
 import json
+import multiprocessing
 import os
 import random
+import re
 import shlex
 import string
 import subprocess
+import threading
 import urllib2
 
-from passlib.hash import sha512_crypt
+_hash_pool = None
+_hash_pool_pid = None
+_hash_pool_lock = threading.Lock()
 
 
 def version():
+    import git
     release = '0.7'
     try:
         g = git.repo.Repo("./")
@@ -54,6 +59,104 @@ def download(url, file=None, crit=False):
         if crit:
             raise
 
+class JSONBase64Reader:
+    # File-like reader over a JSON document whose given key holds a base64
+    # string, e.g. an API response. The value is decoded as it streams in,
+    # so memory use stays bounded however large the payload; sha256 of the
+    # decoded bytes is kept up to date in self.hash. The rest of the
+    # document is available from document() once the value has been read.
+    def __init__(self, fileobj, key, chunk=65536, preview=4096):
+        self.fileobj = fileobj
+        self.chunk = chunk
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self._start = re.compile('"%s"\\s*:\\s*"' % re.escape(key))
+        self._preview = preview
+        self._head = ""
+        self._value = ""
+        self._after = ""
+        self._raw = ""
+        self._buf = ""
+        self._state = 0
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buf) < size) and self._fill():
+            pass
+        if size < 0:
+            data, self._buf = self._buf, ""
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def document(self):
+        # Reads the response to the end and parses it, with the value kept
+        # only if it was short (an error message, say); None if the
+        # response is not JSON
+        rest = []
+        while True:
+            data = self.fileobj.read(self.chunk)
+            if not data:
+                break
+            rest.append(data)
+        rest = "".join(rest)
+        if self._state == 0:
+            doc = self._head + rest
+        else:
+            if self._state == 1:
+                end = rest.find('"')
+                if self._value is not None:
+                    self._value += rest[:end] if end >= 0 else rest
+                self._after = rest[end+1:] if end >= 0 else ""
+                rest = ""
+            value = self._value if self._value is not None and \
+                len(self._value) <= self._preview else ""
+            doc = self._head + '"' + value + '"' + self._after + rest
+        try:
+            return json.loads(doc)
+        except ValueError:
+            return None
+
+    def _fill(self):
+        # States: 0 looking for the key, 1 inside its value, 2 done
+        if self._state == 2:
+            return False
+        data = self.fileobj.read(self.chunk)
+        if not data:
+            raise IOError("Response ended before the data was complete")
+        if self._state == 0:
+            self._head += data
+            m = self._start.search(self._head)
+            if not m:
+                return True
+            data, self._head = self._head[m.end():], self._head[:m.end()-1]
+            self._state = 1
+        end = data.find('"')
+        if end >= 0:
+            data, self._after = data[:end], data[end+1:]
+            self._state = 2
+        if self._value is not None:
+            self._value += data
+            if len(self._value) > self._preview:
+                self._value = None
+        # Hold back escapes split across reads and partial base64 quads
+        raw, keep = self._raw + data, ""
+        if self._state == 1 and raw.endswith("\\"):
+            raw, keep = raw[:-1], "\\"
+        raw = raw.replace("\\/", "/").replace("\\n", "").replace("\\r", "")
+        if self._state == 1:
+            n = len(raw) - len(raw) % 4
+            raw, keep = raw[:n], raw[n:] + keep
+        self._raw = keep
+        data = base64.b64decode(raw)
+        self.hash.update(data)
+        self.size += len(data)
+        self._buf += data
+        return True
+
+
 def get_current_entropy():
     with open("/proc/sys/kernel/random/entropy_avail", "r") as f:
         return int(f.readline())
@@ -95,16 +198,74 @@ def shell(c, stdin=None, env={"LC_ALL": "C"}):
         "stderr": data[1]}
     return data
 
-def hashpw(passw, scheme='sha512_crypt'):
+def hashpw(passw, scheme='sha512_crypt', rounds=None):
     if scheme == 'sha512_crypt':
-        return sha512_crypt.encrypt(passw)
+        from passlib.hash import sha512_crypt
+        return sha512_crypt.encrypt(passw, **({"rounds": rounds} if rounds else {}))
+    elif scheme == 'ldap_sha512_crypt':
+        return "{CRYPT}" + hashpw(passw, 'sha512_crypt', rounds)
     elif scheme == 'crypt':
-        salt = "$1$" + "".join(random.sample(string.ascii_uppercase+string.digits, 8)) + "$"
+        rng = random.SystemRandom()
+        salt = "$1$" + "".join(rng.choice(string.ascii_letters+string.digits+"./") for x in range(8)) + "$"
         return "{CRYPT}" + crypt.crypt(passw, salt)
     elif scheme == 'ssha':
         salt = os.urandom(32)
         return '{SSHA}' + base64.b64encode(hashlib.sha1(passw + salt).digest() + salt)
-    return sha512_crypt.encrypt(passw)
+    return hashpw(passw, 'sha512_crypt', rounds)
+
+def get_hash_pool(processes=None):
+    # Password hashing is CPU-bound by design; a process pool keeps it off
+    # the calling threads and out from under the GIL. Workers forked from
+    # a process that already runs other threads (LDAP, D-Bus mainloops)
+    # can inherit a lock held mid-operation and hang, so the pool is only
+    # created on first use while the process is still single-threaded.
+    # A pool inherited across fork() has no handler threads, so it is
+    # ignored in the child. Returns None when no pool can be used.
+    global _hash_pool, _hash_pool_pid
+    with _hash_pool_lock:
+        if _hash_pool and _hash_pool_pid != os.getpid():
+            _hash_pool = None
+        if not _hash_pool and threading.active_count() == 1:
+            if processes is None:
+                from arkos import config
+                processes = int(config.get("general", "password_workers", 0)) or None
+            _hash_pool = multiprocessing.Pool(processes)
+            _hash_pool_pid = os.getpid()
+        return _hash_pool
+
+def _drop_hash_pool(pool):
+    # A worker stopped answering; don't make later calls wait on it too
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is not pool:
+            return
+        _hash_pool = None
+    pool.terminate()
+
+def hashpw_async(passw, scheme='sha512_crypt', rounds=None):
+    pool = get_hash_pool()
+    if not pool:
+        raise RuntimeError("The password hashing pool was not started")
+    return pool.apply_async(hashpw, (passw, scheme, rounds))
+
+def hashpw_batch(passws, scheme='sha512_crypt', rounds=None, timeout=30):
+    # Hashes in the pool, falling back to hashing in-process when there is
+    # no pool or a worker has not answered within timeout seconds
+    pool = get_hash_pool()
+    if not pool:
+        return [hashpw(x, scheme, rounds) for x in passws]
+    results = [pool.apply_async(hashpw, (x, scheme, rounds)) for x in passws]
+    hashes = []
+    for passw, r in zip(passws, results):
+        if pool:
+            try:
+                hashes.append(r.get(timeout))
+                continue
+            except multiprocessing.TimeoutError:
+                _drop_hash_pool(pool)
+                pool = None
+        hashes.append(hashpw(passw, scheme, rounds))
+    return hashes
 
 def can_be_int(data):
     try: 
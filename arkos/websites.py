@@ -1,12 +1,13 @@
 import ConfigParser
 import git
+import glob
 import os
 import nginx
 import re
 import shutil
 
 from arkos import config, storage, applications, certificates
-from arkos import databases, tracked_services
+from arkos import databases, tracked_services, artifacts
 from arkos.system import users, groups, filesystems
 from arkos.utilities import shell, random_string, DefaultMessage
 
@@ -91,7 +92,6 @@ class Site:
 
         # Make sure the target directory exists, but is empty
         # Testing for sites with the same name should have happened by now
-        pkg_path = '/tmp/'+self.name+ending
         if os.path.isdir(self.path):
             shutil.rmtree(self.path)
         os.makedirs(self.path)
@@ -102,24 +102,27 @@ class Site:
         if self.meta.download_url and ending == '.git':
             git.Repo.clone_from(self.meta.download_url, self.path)
         elif self.meta.download_url:
+            cache = artifacts.get_cache()
             try:
-                download(self.meta.download_url, file=pkg_path, crit=True)
+                pkg_path = cache.fetch(self.meta.download_url, self.meta.version,
+                    getattr(self.meta, "download_sha256", None), bind=False)
             except Exception, e:
                 raise InstallError('Couldn\'t download - %s' % str(e))
 
             if ending in ['.tar.gz', '.tgz', '.tar.bz2']:
                 extract_cmd = 'tar '
                 extract_cmd += 'xzf' if ending in ['.tar.gz', '.tgz'] else 'xjf'
-                extract_cmd += ' /tmp/%s -C %s --strip 1' % (self.name+ending, self.path)
+                extract_cmd += ' %s -C %s --strip 1' % (pkg_path, self.path)
             else:
-                extract_cmd = 'unzip -d %s /tmp/%s' % (self.path, self.name+ending)
+                extract_cmd = 'unzip -d %s %s' % (self.path, pkg_path)
 
             if message:
                 message.update("info", "Installing site...")
             status = shell(extract_cmd)
             if status["code"] >= 1:
+                cache.discard(pkg_path, self.meta.download_url, self.meta.version)
                 raise InstallError(status["stderr"])
-            os.remove(pkg_path)
+            cache.bind(self.meta.download_url, self.meta.version, pkg_path)
 
         self.php = extra_vars.get("php") or self.php
         self.addtoblock = extra_vars.get("addtoblock") or self.addtoblock
@@ -328,6 +331,8 @@ class Site:
             self.name, self.name, self.icon, [("tcp", self.port)], 2)
         self.backup = self.meta.get_module("backup") or backup.BackupController
         self.backup = self.backup(self.name, self)
+        if oldname and self.name != oldname:
+            storage.sites.reindex("sites", self)
         nginx_reload()
 
     def update(self, message=DefaultMessage()):
@@ -352,24 +357,28 @@ class Site:
 
         if message:
             message.update("info", "Downloading website source...")
+        cache = None
         if self.download_url and ending == '.git':
             pkg_path = self.download_url 
         elif self.download_url:
-            pkg_path = os.path.join('/tmp', self.name+ending)
+            cache = artifacts.get_cache()
             try:
-                download(self.meta.download_url, file=pkg_path, crit=True)
+                pkg_path = cache.fetch(self.meta.download_url, self.meta.version,
+                    getattr(self.meta, "download_sha256", None), bind=False)
             except Exception, e:
                 raise Exception('Couldn\'t update - %s' % str(e))
         try:
             if message:
                 message.update("info", "Updating website...")
             self.update_site(self.path, pkg_path, self.version)
+            if cache:
+                cache.bind(self.meta.download_url, self.meta.version, pkg_path)
         except Exception, e:
+            if cache:
+                cache.discard(pkg_path, self.meta.download_url, self.meta.version)
             raise Exception('Couldn\'t update - %s' % str(e))
         finally:
             self.version = self.meta.version.rsplit('-', 1)[0]
-        if pkg_path:
-            os.unlink(pkg_path)
 
     def remove(self, message=DefaultMessage()):
         if message:
@@ -572,17 +581,12 @@ class ReverseProxy:
 def get(id=None, type=None, verify=True):
     data = storage.sites.get("sites")
     if not data:
-        data = scan()
+        data = restore() or scan()
     if id or type:
-        tlist = []
-        for x in data:
-            if x.id == id:
-                return x
-            elif x.meta.id == type:
-                tlist.append(x)
-        if tlist:
-            return tlist
-        return None
+        site = storage.sites.get("sites", id) if id else None
+        if site:
+            return site
+        return storage.sites.get_by("sites", "meta.id", type) or None
     return data
 
 def scan():
@@ -643,8 +647,68 @@ def scan():
             s.pretty_name if hasattr(s, "pretty_name") and s.pretty_name else s.name, 
             s.meta.icon if s.meta else "gen-earth", [("tcp", s.port)])
     storage.sites.set("sites", sites)
+    storage.save_snapshot("sites", [_snapshot(x) for x in sites], _watch())
     return sites
 
+def restore():
+    from arkos import backup
+    data = storage.load_snapshot("sites", _watch())
+    if not data:
+        return None
+    sites = []
+    for x in data:
+        if x["type"] != "ReverseProxy":
+            cls = applications.get(x["type"])
+            s = cls._website(name=x["name"])
+            s.meta = cls
+            s.backup = cls.get_module("backup") or backup.BackupController
+            s.backup = s.backup(s.name, s)
+            s.data_path = x["data_path"]
+            if s.data_path:
+                filesystems.register_point(s.name, s.data_path, "site", cls.icon)
+        else:
+            s = ReverseProxy(name=x["name"])
+            s.pretty_name = x["pretty_name"]
+            s.type = x["extra"]
+            s.meta = None
+            s.backup = None
+        s.port, s.addr, s.path, s.php = x["port"], x["addr"], x["path"], x["php"]
+        s.version, s.enabled = x["version"], x["enabled"]
+        if x["cert"]:
+            s.ssl = True
+            s.cert = certificates.get(x["cert"])
+            s.cert.assign.append({"type": "website", "name": s.name})
+        if x["db"]:
+            s.db = databases.get(x["db"])
+        s.installed = True
+        sites.append(s)
+        tracked_services.register(s.meta.id if s.meta else "website", s.name, 
+            s.pretty_name if hasattr(s, "pretty_name") and s.pretty_name else s.name, 
+            s.meta.icon if s.meta else "gen-earth", [("tcp", s.port)])
+    storage.sites.set("sites", sites)
+    return sites
+
+def _snapshot(s):
+    return {
+        "type": s.meta.id if s.meta else "ReverseProxy",
+        "name": s.name,
+        "pretty_name": getattr(s, "pretty_name", ""),
+        "extra": s.type if not s.meta else "",
+        "port": s.port,
+        "addr": s.addr,
+        "path": s.path,
+        "php": getattr(s, "php", False),
+        "version": getattr(s, "version", None),
+        "data_path": getattr(s, "data_path", ""),
+        "cert": s.cert.id if getattr(s, "cert", None) else None,
+        "db": s.db.id if getattr(s, "db", None) else None,
+        "enabled": s.enabled
+    }
+
+def _watch():
+    return ['/etc/nginx/sites-available', '/etc/nginx/sites-enabled'] \
+        + sorted(glob.glob('/etc/nginx/sites-available/*'))
+
 def nginx_reload():
     status = shell('systemctl restart nginx')
     if status["code"] >= 1:
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""
+Report password hashes per second for each scheme, hashed serially in
+the calling process and in batches through the hashing process pool.
+
+Usage: python benchmarks/hashpw.py [count] [rounds] [scheme ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from arkos.utilities.utils import hashpw, hashpw_batch, get_hash_pool
+
+SCHEMES = ["sha512_crypt", "ldap_sha512_crypt", "crypt", "ssha"]
+
+
+def rate(count, fn):
+    t = time.time()
+    fn()
+    return count / (time.time() - t)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    schemes = sys.argv[3:] or SCHEMES
+    passws = ["password%s" % x for x in range(count)]
+    get_hash_pool()
+    print "%-20s %12s %12s" % ("scheme", "serial/s", "pool/s")
+    for x in schemes:
+        serial = rate(count, lambda: [hashpw(y, x, rounds) for y in passws])
+        pooled = rate(count, lambda: hashpw_batch(passws, x, rounds))
+        print "%-20s %12.1f %12.1f" % (x, serial, pooled)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Report the cost of importing arkos modules.
+
+Each module is imported in a fresh interpreter so the numbers are cold,
+standalone costs, then the connections opened as a side effect are listed.
+
+Usage: python benchmarks/import_time.py [module ...]
+"""
+
+import os
+import subprocess
+import sys
+
+MODULES = [
+    "arkos",
+    "arkos.config",
+    "arkos.storage",
+    "arkos.utilities",
+    "arkos.connections",
+    "arkos.tracked_services",
+    "arkos.applications",
+    "arkos.certificates",
+    "arkos.databases",
+    "arkos.websites",
+    "arkos.system",
+    "arkos.system.users",
+    "arkos.system.services",
+    "arkos.system.stats"
+]
+
+PROBE = """
+import time
+t = time.time()
+import %s
+t = time.time() - t
+import arkos
+print "%%f %%s" %% (t, ",".join(x for x in ["LDAP", "SystemD", "Supervisor"]
+    if arkos.conns.is_connected(x)))
+"""
+
+
+def measure(module):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    p = subprocess.Popen([sys.executable, "-c", PROBE % module], cwd=root,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        return None, err.strip().split("\n")[-1]
+    t, conns = out.strip().split(" ", 1) if " " in out.strip() else (out.strip(), "")
+    return float(t), conns
+
+
+if __name__ == "__main__":
+    print "%-28s %10s  %s" % ("module", "import ms", "connections opened")
+    for x in sys.argv[1:] or MODULES:
+        t, info = measure(x)
+        if t is None:
+            print "%-28s %10s  %s" % (x, "failed", info)
+        else:
+            print "%-28s %10.1f  %s" % (x, t * 1000, info or "-")